@@ -27,7 +27,7 @@ def check_configs_exist():
         if not Path(config).exists():
             raise FileNotFoundError(f"Config file '{config}' does not exist.")
 
-def run_experiment(script, painting_dir, n_steps, transform_file_name="transforms", config=None, output_base=None):
+def run_experiment(script, painting_dir, n_steps, transform_file_name="transforms", config=None, output_base=None, reevaluate=False, reference_from_disk=False, eval_metrics=None, checkpoint_every=1000):
     painting_dir = Path(painting_dir)
     input_dir = painting_dir / transform_file_name / 'leave_one_out'
 
@@ -51,8 +51,17 @@ def run_experiment(script, painting_dir, n_steps, transform_file_name="transform
     for train_file, test_file in zip(train_files, test_files):
         output_dir = painting_dir / transform_file_name / output_base / f'{train_file.stem}_vs_{test_file.stem}'
 
+        # On request, trained runs are re-evaluated, which the evaluation cache serves
+        # without rendering unless the snapshot, test split, render settings or metrics changed
+        snapshot = output_dir / 'model.ingp'
+        evaluate_only = reevaluate and snapshot.exists()
+
+        # Runs that were interrupted after writing a checkpoint are resumed from it
+        checkpoint_dir = output_dir / 'checkpoints'
+        resume = not snapshot.exists() and checkpoint_dir.is_dir() and any(checkpoint_dir.iterdir())
+
         # Skip if the output directory exists and is not empty
-        if output_dir.exists() and any(output_dir.iterdir()):
+        if not evaluate_only and not resume and output_dir.exists() and any(output_dir.iterdir()):
             message = f"Output exists for {output_dir}, skipping..."
             logging.info(message)
             continue
@@ -60,10 +69,10 @@ def run_experiment(script, painting_dir, n_steps, transform_file_name="transform
         output_dir.mkdir(parents=True, exist_ok=True)
 
         # Set up a unique log file for this experiment
-        log_file_path = output_dir / 'experiment.log'
+        log_file_path = output_dir / ('evaluation.log' if evaluate_only else 'experiment.log')
 
         # Create a FileHandler for this log file
-        file_handler = logging.FileHandler(log_file_path, mode='w')
+        file_handler = logging.FileHandler(log_file_path, mode='a' if resume else 'w')
         file_handler.setLevel(logging.INFO)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
@@ -74,18 +83,31 @@ def run_experiment(script, painting_dir, n_steps, transform_file_name="transform
 
         try:
             # Construct the command to run
-            command = [
-                "python3", script,
-                "--scene", str(train_file),
+            evaluation_args = [
                 "--test_transforms", str(test_file),
-                "--n_steps", str(n_steps),
                 "--output_dir", str(output_dir),
-                "--save_snapshot", str(output_dir / 'model.ingp')
+                "--eval_cache_dir", str(input_dir / 'eval_cache')
             ]
-
-            # If a config is provided, add it to the command
-            if config:
-                command.insert(2, str(config))
+            if reference_from_disk:
+                # References are read from disk and decoded once for all configs
+                evaluation_args += ["--reference_from_disk", "--reference_cache_dir", str(input_dir / 'reference_cache')]
+            if eval_metrics:
+                evaluation_args += ["--eval_metrics"] + list(eval_metrics)
+            if evaluate_only:
+                command = ["python3", script, "--load_snapshot", str(snapshot)] + evaluation_args
+            else:
+                command = [
+                    "python3", script,
+                    "--scene", str(train_file),
+                    "--n_steps", str(n_steps),
+                    "--save_snapshot", str(snapshot),
+                    "--checkpoint_every", str(checkpoint_every),
+                    "--resume"
+                ] + evaluation_args
+
+                # If a config is provided, add it to the command
+                if config:
+                    command.insert(2, str(config))
 
             # Log and run the command
             command_message = f"Running command for {painting_dir} with config '{output_base}': {' '.join(command)}"
@@ -99,7 +121,7 @@ def run_experiment(script, painting_dir, n_steps, transform_file_name="transform
             logger.removeHandler(file_handler)
             file_handler.close()
 
-def process_paintings(script, base_dir, n_steps):
+def process_paintings(script, base_dir, n_steps, reevaluate=False, reference_from_disk=False, eval_metrics=None, checkpoint_every=1000):
     base_dir = Path(base_dir)
 
     # Iterate over each painting directory (e.g., painting_1, painting_2, etc.)
@@ -109,13 +131,17 @@ def process_paintings(script, base_dir, n_steps):
 
             # Run experiments for each hardcoded config
             for config, output_base in CONFIGS.items():
-                run_experiment(script, painting_dir, n_steps, "transforms_tight", Path(config), output_base)
+                run_experiment(script, painting_dir, n_steps, "transforms_tight", Path(config), output_base, reevaluate, reference_from_disk, eval_metrics, checkpoint_every)
 
 def main():
     parser = argparse.ArgumentParser(description="Run experiments with train and test JSONs for all paintings.")
     parser.add_argument('--script', type=str, required=True, help='Path to the script to execute')
     parser.add_argument('--base_dir', type=str, required=True, help='Base directory containing painting folders')
     parser.add_argument('--n_steps', type=int, default=35000, help='Number of optimization steps')
+    parser.add_argument('--reevaluate', action='store_true', help='Re-evaluate runs that already have a trained model.ingp instead of skipping them')
+    parser.add_argument('--reference_from_disk', action='store_true', help='Read the test references from disk instead of rendering them (see run.py)')
+    parser.add_argument('--eval_metrics', nargs='+', help='Metrics to evaluate, e.g. MSE PSNR SSIM FLIP. Defaults to those of run.py')
+    parser.add_argument('--checkpoint_every', type=int, default=1000, help='Write a training checkpoint every this many steps, from which interrupted runs are resumed. 0 disables checkpoints')
 
     args = parser.parse_args()
 
@@ -123,7 +149,7 @@ def main():
     check_configs_exist()
 
     # Process all painting directories with the provided configs
-    process_paintings(args.script, args.base_dir, args.n_steps)
+    process_paintings(args.script, args.base_dir, args.n_steps, args.reevaluate, args.reference_from_disk, args.eval_metrics, args.checkpoint_every)
 
 if __name__ == "__main__":
     main()
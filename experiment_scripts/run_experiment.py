@@ -1,7 +1,7 @@
 import subprocess
 import logging
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 # Hardcoded configs with corresponding output directories
 CONFIGS = {
@@ -32,6 +32,10 @@ def run_experiment(submit_config: Dict[str, Any], **kwargs):
             - datasets_dir (str): Base directory containing painting folders.
             - n_steps (int, o./ptional): Number of optimization steps. Defaults to 35000.
             - transform_file_name (str, optional): Name of the transforms directory. Defaults to 'transforms_tight'.
+            - reevaluate (bool, optional): Re-evaluate runs that already have a trained model.ingp instead of skipping them. Defaults to False.
+            - reference_from_disk (bool, optional): Read the test references from disk instead of rendering them. Defaults to False.
+            - eval_metrics (list, optional): Metrics to evaluate, e.g. ['MSE', 'PSNR', 'SSIM', 'FLIP']. Defaults to those of the script.
+            - checkpoint_every (int, optional): Write a training checkpoint every this many steps, from which interrupted runs are resumed. 0 disables checkpoints. Defaults to 1000.
     """
     # Set up logging to log only to the console
     logging.basicConfig(
@@ -45,6 +49,10 @@ def run_experiment(submit_config: Dict[str, Any], **kwargs):
     datasets_dir = kwargs.get('datasets_dir')
     n_steps = kwargs.get('n_steps', 35000)
     transform_file_name = kwargs.get('transform_file_name', 'transforms_tight')
+    reevaluate = kwargs.get('reevaluate', False)
+    reference_from_disk = kwargs.get('reference_from_disk', False)
+    eval_metrics = kwargs.get('eval_metrics')
+    checkpoint_every = kwargs.get('checkpoint_every', 1000)
     run_dir = submit_config.get('run_dir', '.')
     output_dir = submit_config.get('output_dir', run_dir)
 
@@ -72,11 +80,17 @@ def run_experiment(submit_config: Dict[str, Any], **kwargs):
                     config_path=Path(config_path),
                     output_base=output_base,
                     run_dir=run_dir,
-                    output_dir=output_dir
+                    output_dir=output_dir,
+                    reevaluate=reevaluate,
+                    reference_from_disk=reference_from_disk,
+                    eval_metrics=eval_metrics,
+                    checkpoint_every=checkpoint_every
                 )
 
 def run_single_experiment(script: str, painting_dir: Path, n_steps: int, transform_file_name: str,
-                          config_path: Path, output_base: str, run_dir: str, output_dir: str):
+                          config_path: Path, output_base: str, run_dir: str, output_dir: str,
+                          reevaluate: bool = False, reference_from_disk: bool = False,
+                          eval_metrics: Optional[List[str]] = None, checkpoint_every: int = 1000):
     """
     Run a single experiment for a painting directory with a specific config.
 
@@ -89,6 +103,10 @@ def run_single_experiment(script: str, painting_dir: Path, n_steps: int, transfo
         output_base (str): Base name for the output directory.
         run_dir (str): Directory to run the experiments in.
         output_dir (str): Base output directory.
+        reevaluate (bool): Re-evaluate runs that already have a trained model.ingp instead of skipping them.
+        reference_from_disk (bool): Read the test references from disk instead of rendering them.
+        eval_metrics (list): Metrics to evaluate. Defaults to those of the script.
+        checkpoint_every (int): Write a training checkpoint every this many steps. 0 disables checkpoints.
     """
     input_dir = painting_dir / transform_file_name / 'leave_one_out'
 
@@ -114,16 +132,25 @@ def run_single_experiment(script: str, painting_dir: Path, n_steps: int, transfo
         experiment_name = f'{train_file.stem}_vs_{test_file.stem}'
         experiment_output_dir = output_base_dir / experiment_name
 
+        # On request, trained runs are re-evaluated, which the evaluation cache serves
+        # without rendering unless the snapshot, test split, render settings or metrics changed
+        snapshot = experiment_output_dir / 'model.ingp'
+        evaluate_only = reevaluate and snapshot.exists()
+
+        # Runs that were interrupted after writing a checkpoint are resumed from it
+        checkpoint_dir = experiment_output_dir / 'checkpoints'
+        resume = not snapshot.exists() and checkpoint_dir.is_dir() and any(checkpoint_dir.iterdir())
+
         # Skip if the output directory exists and is not empty
-        if experiment_output_dir.exists() and any(experiment_output_dir.iterdir()):
+        if not evaluate_only and not resume and experiment_output_dir.exists() and any(experiment_output_dir.iterdir()):
             logging.info(f"Output exists for {experiment_output_dir}, skipping...")
             continue
 
         experiment_output_dir.mkdir(parents=True, exist_ok=True)
 
         # Set up a unique log file for this experiment
-        log_file_path = experiment_output_dir / 'experiment.log'
-        file_handler = logging.FileHandler(log_file_path, mode='w')
+        log_file_path = experiment_output_dir / ('evaluation.log' if evaluate_only else 'experiment.log')
+        file_handler = logging.FileHandler(log_file_path, mode='a' if resume else 'w')
         file_handler.setLevel(logging.INFO)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
@@ -134,15 +161,28 @@ def run_single_experiment(script: str, painting_dir: Path, n_steps: int, transfo
 
         try:
             # Construct the command to run
-            command = [
-                "python3", script,
-                str(config_path),
-                "--scene", str(train_file),
+            evaluation_args = [
                 "--test_transforms", str(test_file),
-                "--n_steps", str(n_steps),
                 "--output_dir", str(experiment_output_dir),
-                "--save_snapshot", str(experiment_output_dir / 'model.ingp')
+                "--eval_cache_dir", str(Path(output_dir) / 'eval_cache')
             ]
+            if reference_from_disk:
+                # References are read from disk and decoded once for all configs
+                evaluation_args += ["--reference_from_disk", "--reference_cache_dir", str(Path(output_dir) / 'reference_cache')]
+            if eval_metrics:
+                evaluation_args += ["--eval_metrics"] + list(eval_metrics)
+            if evaluate_only:
+                command = ["python3", script, "--load_snapshot", str(snapshot)] + evaluation_args
+            else:
+                command = [
+                    "python3", script,
+                    str(config_path),
+                    "--scene", str(train_file),
+                    "--n_steps", str(n_steps),
+                    "--save_snapshot", str(snapshot),
+                    "--checkpoint_every", str(checkpoint_every),
+                    "--resume"
+                ] + evaluation_args
 
             # Log and run the command
             logging.info(f"Running command for {painting_dir} with config '{output_base}': {' '.join(command)}")
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2022, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+import argparse
+import common
+import numpy as np
+import time
+import tracemalloc
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark the image encoding pipeline of write_image on synthetic frames.")
+	parser.add_argument("--width", type=int, default=1920, help="Frame width.")
+	parser.add_argument("--height", type=int, default=1080, help="Frame height.")
+	parser.add_argument("--frames", type=int, default=10, help="Number of frames to encode per variant.")
+	args = parser.parse_args()
+	return args
+
+def legacy_encode(img):
+	# The encoding steps of write_image before ImageWriter was introduced.
+	if img.shape[2] == 4:
+		img = np.copy(img)
+		img[...,0:3] = np.divide(img[...,0:3], img[...,3:4], out=np.zeros_like(img[...,0:3]), where=img[...,3:4] != 0)
+		img[...,0:3] = common.linear_to_srgb(img[...,0:3])
+	else:
+		img = common.linear_to_srgb(img)
+	return (np.clip(img, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+def measure(name, fn, frames):
+	fn(frames[0]) # warm up, so that persistent buffers are not counted
+	tracemalloc.start()
+	start = time.perf_counter()
+	for frame in frames:
+		tracemalloc.reset_peak()
+		fn(frame)
+	elapsed = time.perf_counter() - start
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(f"{name:>12}: {1000 * elapsed / len(frames):8.2f} ms/frame, peak temporary allocations {peak / 2**20:8.2f} MiB/frame")
+
+if __name__ == "__main__":
+	args = parse_args()
+	rng = np.random.default_rng(0)
+	frame = rng.random((args.height, args.width, 4), dtype=np.float32)
+	frame[...,0:3] *= frame[...,3:4]
+	frames = [frame] * args.frames
+
+	print(f"Encoding {args.frames} frames of {args.width}x{args.height} RGBA")
+	writer = common.ImageWriter()
+	measure("legacy", legacy_encode, frames)
+	measure("ImageWriter", writer.encode, frames)
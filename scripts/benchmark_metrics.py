@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2022, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+import argparse
+import numpy as np
+import time
+
+import scripts.flip as flip
+from scripts.common import MS_SSIM, SSIM, MetricEngine, compute_error
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark the error metrics on synthetic image pairs. Run from the repository root as a module: python -m scripts.benchmark_metrics")
+	parser.add_argument("--width", type=int, default=1920, help="Image width.")
+	parser.add_argument("--height", type=int, default=1080, help="Image height.")
+	parser.add_argument("--monitor_resolution_x", type=int, default=3840, help="Horizontal monitor resolution used to derive FLIP's pixels per degree.")
+	parser.add_argument("--skip_reference", action="store_true", help="Don't run the reference implementations, which can take minutes on large images.")
+	args = parser.parse_args()
+	return args
+
+def timed(fn):
+	start = time.perf_counter()
+	result = fn()
+	return result, time.perf_counter() - start
+
+def synthetic_pair(width, height):
+	rng = np.random.default_rng(0)
+	reference = rng.random((3, height, width))
+	test = np.clip(reference + rng.normal(0.0, 0.05, reference.shape), 0.0, 1.0)
+	return reference, test
+
+def benchmark_flip(args, reference, test):
+	# Same viewing conditions as common.compute_error_img, apart from the monitor resolution.
+	pixels_per_degree = 0.7 * (args.monitor_resolution_x / 0.7) * (np.pi / 180)
+	print(f"FLIP at {pixels_per_degree:.1f} pixels per degree")
+
+	variants = [
+		("separable", lambda: flip.compute_flip(reference, test, pixels_per_degree, use_fft=False)),
+		("fft", lambda: flip.compute_flip(reference, test, pixels_per_degree, use_fft=True)),
+	]
+	if not args.skip_reference:
+		variants.insert(0, ("2D", lambda: flip.compute_flip(reference, test, pixels_per_degree, separable=False)))
+
+	baseline = None
+	for name, fn in variants:
+		result, elapsed = timed(fn)
+		if baseline is None:
+			baseline = result
+		print(f"{name:>12}: {elapsed:8.2f} s, mean={np.mean(result):.6f}, max abs diff={np.max(np.abs(result - baseline)):.2e}")
+
+def benchmark_ssim(reference, test):
+	a = reference.transpose(1, 2, 0)
+	b = test.transpose(1, 2, 0)
+	for name, fn in [
+		("SSIM", lambda: np.mean(SSIM(a, b))),
+		("SSIM fp32", lambda: np.mean(SSIM(a, b, np.float32))),
+		("MS-SSIM", lambda: MS_SSIM(a, b)),
+		("MS-SSIM fp32", lambda: MS_SSIM(a, b, np.float32)),
+	]:
+		result, elapsed = timed(fn)
+		print(f"{name:>12}: {elapsed:8.2f} s, value={result:.6f}")
+
+def check_metric_engine(reference, test, size=256):
+	# MetricEngine delegates FLIP to compute_error(), which expects linear input.
+	a = test.transpose(1, 2, 0)[:size, :size]
+	b = reference.transpose(1, 2, 0)[:size, :size]
+	engine = MetricEngine(["FLIP"]).compute_pair(a, b)["FLIP"]
+	expected = compute_error("FLIP", a.copy(), b)
+	print(f"{'FLIP check':>12}: MetricEngine {engine:.8f}, compute_error {expected:.8f}")
+	assert np.isclose(engine, expected, rtol=1e-12, atol=0), "MetricEngine disagrees with compute_error on FLIP"
+
+if __name__ == "__main__":
+	args = parse_args()
+	print(f"Image pair of {args.width}x{args.height} pixels")
+	reference, test = synthetic_pair(args.width, args.height)
+	benchmark_flip(args, reference, test)
+	benchmark_ssim(reference, test)
+	check_metric_engine(reference, test)
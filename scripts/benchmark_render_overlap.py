@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2022, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+import argparse
+import common
+import os
+import tempfile
+import time
+
+import pyngp as ngp # noqa
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Measure how well image writing and metric evaluation on background threads overlap with testbed.render(). Requires pyngp on the Python path.")
+	parser.add_argument("--snapshot", required=True, help="Snapshot to render.")
+	parser.add_argument("--width", type=int, default=1920, help="Frame width.")
+	parser.add_argument("--height", type=int, default=1080, help="Frame height.")
+	parser.add_argument("--spp", type=int, default=8, help="Samples per pixel.")
+	parser.add_argument("--frames", type=int, default=20, help="Number of frames per variant.")
+	args = parser.parse_args()
+	return args
+
+def measure(name, fn, frames):
+	start = time.perf_counter()
+	fn(frames)
+	elapsed = time.perf_counter() - start
+	print(f"{name:>28}: {1000 * elapsed / frames:8.2f} ms/frame")
+
+if __name__ == "__main__":
+	args = parse_args()
+	testbed = ngp.Testbed()
+	testbed.load_snapshot(args.snapshot)
+	render = lambda: testbed.render(args.width, args.height, args.spp, True)
+	ref = render()
+	engine = common.MetricEngine(["MSE", "PSNR", "SSIM"])
+	out_dir = tempfile.mkdtemp()
+
+	def render_only(n):
+		for _ in range(n):
+			render()
+
+	def write_sync(n):
+		for i in range(n):
+			common.write_image(os.path.join(out_dir, f"{i:04d}.png"), render())
+
+	def write_async(n):
+		with common.AsyncImageWriter() as writer:
+			for i in range(n):
+				writer.write(os.path.join(out_dir, f"{i:04d}.png"), render())
+
+	def evaluate_sync(n):
+		for _ in range(n):
+			engine.compute_pair(render(), ref)
+
+	def evaluate_pipelined(n):
+		with common.EvaluationPipeline(engine) as pipeline:
+			for i in range(n):
+				pipeline.submit(i, render(), ref)
+			pipeline.results()
+
+	print(f"{args.frames} frames of {args.width}x{args.height} at {args.spp} spp")
+	measure("render", render_only, args.frames)
+	measure("render + write_image", write_sync, args.frames)
+	measure("render + AsyncImageWriter", write_async, args.frames)
+	measure("render + metrics", evaluate_sync, args.frames)
+	measure("render + EvaluationPipeline", evaluate_pipelined, args.frames)
@@ -9,14 +9,25 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 import code
+import collections
+import concurrent.futures
+import contextlib
 import glob
+import hashlib
 import imageio
+import json
 import numpy as np
 import os
 from pathlib import Path, PurePosixPath
+from PIL import Image, UnidentifiedImageError
+import queue
 from scipy.ndimage.filters import convolve1d
 import struct
+import subprocess
 import sys
+import threading
+import time
+import zlib
 
 import scripts.flip as flip
 import scripts.flip.utils
@@ -120,7 +131,8 @@ def diagonally_combine_images(images, x_thresholds, angle, gap=0, color=1):
 	return result
 
 def write_image_imageio(img_file, img, quality):
-	img = (np.clip(img, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+	if img.dtype != np.uint8:
+		img = (np.clip(img, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
 	kwargs = {}
 	if os.path.splitext(img_file)[1].lower() in [".jpg", ".jpeg"]:
 		if img.ndim >= 3 and img.shape[2] > 3:
@@ -129,11 +141,65 @@ def write_image_imageio(img_file, img, quality):
 		kwargs["subsampling"] = 0
 	imageio.imwrite(img_file, img, **kwargs)
 
-def read_image_imageio(img_file):
-	img = imageio.imread(img_file)
-	img = np.asarray(img).astype(np.float32)
+def scaled_size(width, height, scale):
+	return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+def downscale_area(img, scale):
+	# Area (box) resampling of an HWC array. Integer reduction factors average
+	# whole blocks; other factors go through PIL's box filter per channel.
+	h, w = img.shape[0], img.shape[1]
+	new_w, new_h = scaled_size(w, h, scale)
+	if (new_w, new_h) == (w, h):
+		return img
+	factor = 1.0 / scale
+	if factor == int(factor) and h // int(factor) == new_h and w // int(factor) == new_w:
+		k = int(factor)
+		result = np.empty((new_h, new_w, img.shape[2]), dtype=np.float32)
+		# Work in strips, so that memory-mapped inputs are never converted to float as a whole.
+		for y in range(0, new_h, 64):
+			n = min(64, new_h - y)
+			blocks = np.asarray(img[y*k:(y+n)*k, :new_w*k], dtype=np.float32).reshape(n, k, new_w, k, img.shape[2])
+			result[y:y+n] = blocks.mean(axis=(1, 3))
+		return result
+	# PIL resamples one float channel at a time. The planes are gathered from row
+	# strips, which memory-mapped and tiled '.bin' images both support.
+	planes = np.empty((img.shape[2], h, w), dtype=np.float32)
+	for y in range(0, h, 64):
+		planes[:, y:y+64] = np.asarray(img[y:y+64], dtype=np.float32).transpose(2, 0, 1)
+	channels = [np.asarray(Image.fromarray(plane, mode="F").resize((new_w, new_h), Image.BOX)) for plane in planes]
+	return np.stack(channels, axis=2)
+
+def read_image_imageio_raw(img_file, scale=1):
+	# Returns the image in its stored representation, e.g. uint8 for JPEGs.
+	# With scale < 1, JPEGs are decoded at reduced resolution in the DCT domain
+	# (1/2, 1/4 or 1/8, whichever is closest above the requested size) and the
+	# remainder, as well as any other format, is area-resampled. Formats PIL can not
+	# open, such as EXR, are decoded by imageio at full resolution first.
+	if scale == 1:
+		img = np.asarray(imageio.imread(img_file))
+	else:
+		try:
+			im = Image.open(img_file)
+		except UnidentifiedImageError:
+			img = np.asarray(imageio.imread(img_file))
+			return downscale_area(img if img.ndim == 3 else img[:,:,np.newaxis], scale)
+		with im:
+			size = scaled_size(im.width, im.height, scale)
+			if im.format == "JPEG":
+				im.draft(im.mode, size)
+			if im.mode in ["P", "PA", "1"]:
+				# Resample colors rather than palette indices, like imageio's decoding at full scale.
+				im = im.convert("RGBA" if im.mode == "PA" or "transparency" in im.info else "RGB")
+			if im.mode in ["F", "I"]:
+				img = downscale_area(np.asarray(im)[:,:,np.newaxis], size[0] / im.width)
+			else:
+				img = np.asarray(im.resize(size, Image.BOX) if im.size != size else im)
 	if len(img.shape) == 2:
 		img = img[:,:,np.newaxis]
+	return img
+
+def read_image_imageio(img_file):
+	img = read_image_imageio_raw(img_file).astype(np.float32)
 	return img / 255.0
 
 def srgb_to_linear(img):
@@ -144,66 +210,882 @@ def linear_to_srgb(img):
 	limit = 0.0031308
 	return np.where(img > limit, 1.055 * (img ** (1.0 / 2.4)) - 0.055, 12.92 * img)
 
-def read_image(file):
-	if os.path.splitext(file)[1] == ".bin":
+# Lookup tables for 8/16-bit images, where every possible input value can be
+# converted up front. A gather then replaces the per-pixel np.power.
+_SRGB_LUTS = {}
+
+def is_lut_dtype(dtype):
+	dtype = np.dtype(dtype)
+	return dtype in (np.uint8, np.uint16) or dtype == np.float16
+
+def _lut_indices(img):
+	# float16 images are looked up by their bit pattern.
+	return img.view(np.uint16) if img.dtype == np.float16 else img
+
+def srgb_to_linear_lut(dtype, out_dtype=np.float32):
+	key = ("srgb_to_linear", np.dtype(dtype), np.dtype(out_dtype))
+	if key not in _SRGB_LUTS:
+		n = np.iinfo(dtype).max
+		# In float32, like read_image() on a decoded image, so that both agree bit for bit.
+		_SRGB_LUTS[key] = srgb_to_linear(np.arange(n + 1, dtype=np.float32) / np.float32(n)).astype(out_dtype)
+	return _SRGB_LUTS[key]
+
+def unorm_lut(dtype, out_dtype=np.float32):
+	key = ("unorm", np.dtype(dtype), np.dtype(out_dtype))
+	if key not in _SRGB_LUTS:
+		n = np.iinfo(dtype).max
+		_SRGB_LUTS[key] = (np.arange(n + 1, dtype=np.float64) / n).astype(out_dtype)
+	return _SRGB_LUTS[key]
+
+def linear_to_srgb8_lut(dtype):
+	# Maps linear values to clamped, quantized 8-bit sRGB, i.e. the result of
+	# linear_to_srgb() followed by the quantization in write_image_imageio().
+	key = ("linear_to_srgb8", np.dtype(dtype))
+	if key not in _SRGB_LUTS:
+		if np.dtype(dtype) == np.float16:
+			values = np.arange(65536, dtype=np.uint16).view(np.float16).astype(np.float64)
+			values = np.nan_to_num(values, nan=0.0)
+		else:
+			n = np.iinfo(dtype).max
+			values = np.arange(n + 1, dtype=np.float64) / n
+		srgb = np.clip(linear_to_srgb(np.clip(values, 0.0, 1.0)), 0.0, 1.0)
+		_SRGB_LUTS[key] = (srgb * 255.0 + 0.5).astype(np.uint8)
+	return _SRGB_LUTS[key]
+
+def decode_srgb_image(img, out=None, dtype=np.float32, strip_rows=64):
+	# Fused decode + linearize + premultiply of an 8/16-bit sRGB image. Writes
+	# straight into `out` (float16 or float32) without full-size float temporaries.
+	if out is None:
+		out = np.empty(img.shape, dtype=dtype)
+	if img.shape[2] == 4 and out.dtype != np.float32:
+		# Premultiply in float32, a strip at a time, and round to the output type
+		# once, as read_image() followed by a cast would.
+		for y in range(0, img.shape[0], strip_rows):
+			out[y:y+strip_rows] = decode_srgb_image(img[y:y+strip_rows])
+		return out
+	c = min(img.shape[2], 3)
+	np.take(srgb_to_linear_lut(img.dtype, out.dtype), img[...,:c], out=out[...,:c])
+	if img.shape[2] == 4:
+		np.take(unorm_lut(img.dtype, out.dtype), img[...,3], out=out[...,3])
+		# Premultiply alpha
+		out[...,0:3] *= out[...,3:4]
+	return out
+
+def encode_srgb_image(img):
+	# Encodes a linear 8/16-bit integer or float16 image to 8-bit sRGB via lookup.
+	# Alpha is not unmultiplied, so this is only exact for images without
+	# transparency; see can_encode_srgb_lut().
+	c = min(img.shape[2], 3)
+	out = np.empty(img.shape, dtype=np.uint8)
+	np.take(linear_to_srgb8_lut(img.dtype), _lut_indices(img[...,:c]), out=out[...,:c])
+	if img.shape[2] > 3:
+		out[...,3:] = 255
+	return out
+
+def can_encode_srgb_lut(img):
+	if not is_lut_dtype(img.dtype):
+		return False
+	if img.shape[2] < 4:
+		return True
+	one = 1.0 if img.dtype == np.float16 else np.iinfo(img.dtype).max
+	return bool(np.all(img[...,3:] == one))
+
+# The '.bin' format comes in two versions. Version 1 is a struct.pack("ii", h, w)
+# header followed by raw fp16 RGBA and is what the native image loader reads.
+# Version 2 starts with BIN_V2_MAGIC, splits the image into square tiles that
+# are stored independently (optionally zlib-compressed) and keeps an index of
+# (offset, size) per tile, so regions can be read without touching the rest.
+BIN_V2_MAGIC = b"NGPT"
+BIN_V2_HEADER = "<4s6I" # magic, version, height, width, channels, tile size, compression
+BIN_COMPRESSION_NONE = 0
+BIN_COMPRESSION_ZLIB = 1
+
+def read_bin_header(file):
+	with open(file, "rb") as f:
+		magic = f.read(4)
+		if magic == BIN_V2_MAGIC:
+			f.seek(0)
+			_, version, h, w, _, _, _ = struct.unpack(BIN_V2_HEADER, f.read(struct.calcsize(BIN_V2_HEADER)))
+			return version, h, w
+		h, w = struct.unpack("ii", magic + f.read(4))
+		return 1, h, w
+
+class TiledBinImage:
+	# Lazy reader for version 2 '.bin' files. Indexing with [rows, cols] decodes
+	# only the tiles that overlap the requested region and returns fp16 data.
+	dtype = np.dtype(np.float16)
+	ndim = 3
+
+	def __init__(self, file):
+		self.file = file
 		with open(file, "rb") as f:
-			bytes = f.read()
-			h, w = struct.unpack("ii", bytes[:8])
-			img = np.frombuffer(bytes, dtype=np.float16, count=h*w*4, offset=8).astype(np.float32).reshape([h, w, 4])
+			header = f.read(struct.calcsize(BIN_V2_HEADER))
+			magic, version, h, w, c, tile_size, compression = struct.unpack(BIN_V2_HEADER, header)
+			if magic != BIN_V2_MAGIC or version != 2:
+				raise ValueError(f"{file} is not a version 2 '.bin' file.")
+			self.shape = (h, w, c)
+			self.tile_size = tile_size
+			self.compression = compression
+			self.n_tiles = ((h + tile_size - 1) // tile_size, (w + tile_size - 1) // tile_size)
+			self.index = np.fromfile(f, dtype="<u8", count=self.n_tiles[0]*self.n_tiles[1]*2).reshape(self.n_tiles[0], self.n_tiles[1], 2)
+
+	def tile_shape(self, ty, tx):
+		return (min(self.tile_size, self.shape[0] - ty * self.tile_size), min(self.tile_size, self.shape[1] - tx * self.tile_size), self.shape[2])
+
+	def read_tile(self, ty, tx, f=None):
+		offset, size = self.index[ty, tx]
+		if f is None:
+			with open(self.file, "rb") as f:
+				return self.read_tile(ty, tx, f)
+		f.seek(int(offset))
+		data = f.read(int(size))
+		if self.compression == BIN_COMPRESSION_ZLIB:
+			data = zlib.decompress(data)
+		return np.frombuffer(data, dtype=np.float16).reshape(self.tile_shape(ty, tx))
+
+	def read_window(self, y0, y1, x0, x1):
+		t = self.tile_size
+		result = np.empty((y1 - y0, x1 - x0, self.shape[2]), dtype=np.float16)
+		with open(self.file, "rb") as f:
+			for ty in range(y0 // t, (y1 + t - 1) // t):
+				for tx in range(x0 // t, (x1 + t - 1) // t):
+					tile = self.read_tile(ty, tx, f)
+					ty0, tx0 = ty * t, tx * t
+					sy0, sy1 = max(y0, ty0), min(y1, ty0 + tile.shape[0])
+					sx0, sx1 = max(x0, tx0), min(x1, tx0 + tile.shape[1])
+					result[sy0-y0:sy1-y0, sx0-x0:sx1-x0] = tile[sy0-ty0:sy1-ty0, sx0-tx0:sx1-tx0]
+		return result
+
+	def __getitem__(self, key):
+		if not isinstance(key, tuple):
+			key = (key,)
+		rows = key[0] if len(key) > 0 else slice(None)
+		cols = key[1] if len(key) > 1 else slice(None)
+		if not isinstance(rows, slice) or not isinstance(cols, slice):
+			raise TypeError("TiledBinImage only supports slice indexing of rows and columns.")
+		y0, y1, ystep = rows.indices(self.shape[0])
+		x0, x1, xstep = cols.indices(self.shape[1])
+		if ystep < 0 or xstep < 0:
+			raise TypeError("TiledBinImage does not support negative strides.")
+		return self.read_window(y0, max(y0, y1), x0, max(x0, x1))[::ystep, ::xstep][(slice(None), slice(None)) + key[2:]]
+
+	def __array__(self, dtype=None, copy=None):
+		img = self.read_window(0, self.shape[0], 0, self.shape[1])
+		return img if dtype is None else img.astype(dtype)
+
+class TiledBinWriter:
+	# Streams an image into a version 2 '.bin' file. Rows are appended with
+	# write_rows() in any chunk size; only one strip of tiles is kept in memory.
+	def __init__(self, file, height, width, tile_size=256, compress=False):
+		self.shape = (height, width, 4)
+		self.tile_size = tile_size
+		self.compression = BIN_COMPRESSION_ZLIB if compress else BIN_COMPRESSION_NONE
+		self.n_tiles = ((height + tile_size - 1) // tile_size, (width + tile_size - 1) // tile_size)
+		self.index = np.zeros((self.n_tiles[0], self.n_tiles[1], 2), dtype="<u8")
+		self.strip = np.empty((tile_size, width, 4), dtype=np.float16)
+		self.strip_rows = 0
+		self.rows_written = 0
+		self.f = open(file, "wb")
+		self.f.write(struct.pack(BIN_V2_HEADER, BIN_V2_MAGIC, 2, height, width, 4, tile_size, self.compression))
+		# Reserve space for the tile index; it is filled in by close().
+		self.index_offset = self.f.tell()
+		self.f.write(self.index.tobytes())
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def write_rows(self, rows):
+		if rows.shape[1] != self.shape[1]:
+			raise ValueError(f"Expected rows of width {self.shape[1]}, got {rows.shape[1]}.")
+		while rows.shape[0] > 0:
+			n = min(rows.shape[0], self.tile_size - self.strip_rows)
+			dst = self.strip[self.strip_rows:self.strip_rows+n]
+			c = min(rows.shape[2], 4)
+			dst[...,:c] = rows[:n,:,:c]
+			dst[...,c:] = 1.0
+			self.strip_rows += n
+			rows = rows[n:]
+			if self.strip_rows == self.tile_size or self.rows_written + self.strip_rows == self.shape[0]:
+				self._flush_strip()
+
+	def _flush_strip(self):
+		ty = self.rows_written // self.tile_size
+		t = self.tile_size
+		for tx in range(self.n_tiles[1]):
+			data = np.ascontiguousarray(self.strip[:self.strip_rows, tx*t:(tx+1)*t]).tobytes()
+			if self.compression == BIN_COMPRESSION_ZLIB:
+				data = zlib.compress(data)
+			self.index[ty, tx] = (self.f.tell(), len(data))
+			self.f.write(data)
+		self.rows_written += self.strip_rows
+		self.strip_rows = 0
+
+	def close(self):
+		if self.f.closed:
+			return
+		if self.rows_written != self.shape[0]:
+			self.f.close()
+			raise ValueError(f"Only {self.rows_written} of {self.shape[0]} rows were written.")
+		self.f.seek(self.index_offset)
+		self.f.write(self.index.tobytes())
+		self.f.close()
+
+def read_image_mmap(file):
+	# Maps the fp16 RGBA payload of a '.bin' file without reading it.
+	# Pages are only faulted in for the pixels that are actually touched.
+	# Version 2 files return a TiledBinImage, which decodes tiles on access.
+	version, h, w = read_bin_header(file)
+	if version == 2:
+		return TiledBinImage(file)
+	return np.memmap(file, dtype=np.float16, mode="r", offset=8, shape=(h, w, 4))
+
+def read_image_window(img, y0, y1, x0, x1):
+	# Returns a float32 copy of img[y0:y1, x0:x1]. Works on memory-mapped
+	# images, so only the requested region is loaded from disk.
+	return np.asarray(img[y0:y1, x0:x1], dtype=np.float32)
+
+def linearize_image(img):
+	# Converts an sRGB image with values in [0, 1] to linear, premultiplied RGB(A).
+	if img.shape[2] == 4:
+		img[...,0:3] = srgb_to_linear(img[...,0:3])
+		# Premultiply alpha
+		img[...,0:3] *= img[...,3:4]
 	else:
-		img = read_image_imageio(file)
-		if img.shape[2] == 4:
-			img[...,0:3] = srgb_to_linear(img[...,0:3])
-			# Premultiply alpha
-			img[...,0:3] *= img[...,3:4]
-		else:
-			img = srgb_to_linear(img)
+		img = srgb_to_linear(img)
 	return img
 
-def write_image(file, img, quality=95):
+def read_image(file, mmap=False, scale=1):
+	# scale < 1 returns a downscaled image; see read_image_imageio_raw().
 	if os.path.splitext(file)[1] == ".bin":
-		if img.shape[2] < 4:
-			img = np.dstack((img, np.ones([img.shape[0], img.shape[1], 4 - img.shape[2]])))
-		with open(file, "wb") as f:
-			f.write(struct.pack("ii", img.shape[0], img.shape[1]))
-			f.write(img.astype(np.float16).tobytes())
+		if mmap:
+			if scale != 1:
+				raise ValueError("Memory-mapped images can not be read at reduced scale.")
+			return read_image_mmap(file)
+		if scale != 1:
+			# Resample straight from the mapped file to avoid a full-resolution float copy.
+			return downscale_area(read_image_mmap(file), scale)
+		version, h, w = read_bin_header(file)
+		if version == 2:
+			return np.asarray(TiledBinImage(file), dtype=np.float32)
+		with open(file, "rb") as f:
+			f.seek(8)
+			img = np.fromfile(f, dtype=np.float16, count=h*w*4).reshape([h, w, 4]).astype(np.float32)
 	else:
-		if img.shape[2] == 4:
-			img = np.copy(img)
-			# Unmultiply alpha
-			img[...,0:3] = np.divide(img[...,0:3], img[...,3:4], out=np.zeros_like(img[...,0:3]), where=img[...,3:4] != 0)
-			img[...,0:3] = linear_to_srgb(img[...,0:3])
+		img = read_image_imageio_raw(file, scale)
+		if img.dtype in (np.uint8, np.uint16):
+			return decode_srgb_image(img)
+		img = linearize_image(img.astype(np.float32) / 255.0)
+	return img
+
+class ImageWriter:
+	# Writes linear images to disk. The float -> 8-bit sRGB conversion runs in
+	# chunks of rows through scratch buffers that are kept between calls, so
+	# writing many frames of the same size does not allocate full-size temporaries.
+	def __init__(self, chunk_rows=64):
+		self.chunk_rows = chunk_rows
+		self.scratch = None
+		self.scratch_low = None
+		self.scratch_mask = None
+		self.scratch_alpha = None
+		self.scratch_alpha_mask = None
+		self.out = None
+
+	def _scratch(self, width, channels):
+		shape = (self.chunk_rows, width, channels)
+		if self.scratch is None or self.scratch.shape != shape:
+			self.scratch = np.empty(shape, dtype=np.float32)
+			self.scratch_low = np.empty(shape, dtype=np.float32)
+			self.scratch_mask = np.empty(shape, dtype=bool)
+			self.scratch_alpha = np.empty((self.chunk_rows, width, 1), dtype=np.float32)
+			self.scratch_alpha_mask = np.empty((self.chunk_rows, width, 1), dtype=bool)
+		return self.scratch, self.scratch_low, self.scratch_mask, self.scratch_alpha, self.scratch_alpha_mask
+
+	def _output(self, height, width, channels):
+		shape = (height, width, channels)
+		if self.out is None or self.out.shape != shape:
+			self.out = np.empty(shape, dtype=np.uint8)
+		return self.out
+
+	def encode(self, img, drop_alpha=False):
+		# Unmultiplies alpha, encodes to sRGB and quantizes to 8 bits. The result is a
+		# view of an internal buffer that is overwritten by the next call.
+		# All steps operate on whole, contiguous chunks (alpha is restored afterwards)
+		# because strided per-channel ufuncs are several times slower.
+		h, w, c = img.shape
+		c_out = min(c, 3) if drop_alpha else c
+		out = self._output(h, w, c_out)
+		scratch, low, mask, alpha, alpha_mask = self._scratch(w, c)
+		limit = 0.0031308
+		with np.errstate(divide="ignore", invalid="ignore"):
+			for y0 in range(0, h, self.chunk_rows):
+				y1 = min(y0 + self.chunk_rows, h)
+				src = img[y0:y1]
+				n = y1 - y0
+				s, l, m = scratch[:n], low[:n], mask[:n]
+				np.copyto(s, src, casting="unsafe")
+				if c == 4:
+					# Unmultiply alpha
+					a, am = alpha[:n], alpha_mask[:n]
+					np.copyto(a, s[...,3:4])
+					np.equal(a, 0, out=am)
+					np.divide(s, a, out=s)
+					np.copyto(s, 0.0, where=am)
+				# linear_to_srgb
+				np.multiply(s, 12.92, out=l)
+				np.less_equal(s, limit, out=m)
+				np.power(s, 1.0 / 2.4, out=s)
+				s *= 1.055
+				s -= 0.055
+				np.copyto(s, l, where=m)
+				if c == 4:
+					s[...,3:4] = a
+				# Quantize
+				np.clip(s, 0.0, 1.0, out=s)
+				s *= 255.0
+				s += 0.5
+				np.copyto(out[y0:y1], s[...,:c_out], casting="unsafe")
+		return out
+
+	def write(self, file, img, quality=95, tile_size=0, compress=False):
+		ext = os.path.splitext(file)[1]
+		if ext == ".bin":
+			if tile_size > 0:
+				with TiledBinWriter(file, img.shape[0], img.shape[1], tile_size, compress) as writer:
+					writer.write_rows(img)
+				return
+			if img.shape[2] < 4:
+				img = np.dstack((img, np.ones([img.shape[0], img.shape[1], 4 - img.shape[2]])))
+			with open(file, "wb") as f:
+				f.write(struct.pack("ii", img.shape[0], img.shape[1]))
+				f.write(img.astype(np.float16).tobytes())
+		elif can_encode_srgb_lut(img):
+			write_image_imageio(file, encode_srgb_image(img), quality)
 		else:
-			img = linear_to_srgb(img)
-		write_image_imageio(file, img, quality)
+			drop_alpha = ext.lower() in [".jpg", ".jpeg"]
+			write_image_imageio(file, self.encode(img, drop_alpha), quality)
+
+# One writer per thread, so that concurrent write_image() calls do not share scratch buffers.
+_image_writers = threading.local()
+
+def write_image(file, img, quality=95, tile_size=0, compress=False):
+	writer = getattr(_image_writers, "writer", None)
+	if writer is None:
+		writer = _image_writers.writer = ImageWriter()
+	writer.write(file, img, quality, tile_size, compress)
+
+class BackgroundWorkers:
+	# Runs jobs on a pool of daemon threads fed by a bounded queue, so that the
+	# caller can continue with its own work. _put() blocks once max_pending jobs
+	# are queued. Errors raised by jobs are re-raised by the next _put(), flush() or
+	# close(); on leaving a with block because of an exception, they are dropped
+	# in favor of that exception. Jobs see arrays as they are when they run, so
+	# callers must not modify arrays after handing them over.
+	# Subclasses implement run(job).
+	def __init__(self, n_threads=1, max_pending=8):
+		self.queue = queue.Queue(maxsize=max_pending)
+		self.errors = []
+		self.lock = threading.Lock()
+		self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(n_threads)]
+		for thread in self.threads:
+			thread.start()
+		self.closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			try:
+				self.close()
+			except Exception:
+				pass
+
+	def _worker(self):
+		while True:
+			job = self.queue.get()
+			try:
+				if job is None:
+					return
+				self.run(job)
+			except BaseException as e:
+				with self.lock:
+					self.errors.append(e)
+			finally:
+				self.queue.task_done()
+
+	def run(self, job):
+		raise NotImplementedError()
+
+	def _raise_errors(self):
+		with self.lock:
+			if self.errors:
+				error = self.errors[0]
+				self.errors = []
+				raise error
+
+	def _put(self, job):
+		if self.closed:
+			raise RuntimeError(f"{type(self).__name__} is closed.")
+		self._raise_errors()
+		self.queue.put(job)
+
+	def flush(self):
+		# Waits for all queued jobs.
+		self.queue.join()
+		self._raise_errors()
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		for _ in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self._raise_errors()
+
+class AsyncImageWriter(BackgroundWorkers):
+	# Writes images on background threads, so that rendering can continue while
+	# previous frames are encoded and written to disk.
+	def __init__(self, n_threads=4, max_pending=8):
+		super().__init__(n_threads, max_pending)
+
+	def run(self, job):
+		write_image(*job)
+
+	def write(self, file, img, quality=95):
+		self._put((file, img, quality))
+
+class VideoWriter(BackgroundWorkers):
+	# Streams frames into an ffmpeg process as raw 8-bit sRGB on its stdin, so that
+	# no intermediate images are written to disk. Frames are quantized on a
+	# background thread while the next one renders; the pipe blocks that thread
+	# whenever ffmpeg's encoder falls behind. close() waits for ffmpeg to finish the file.
+	def __init__(self, file, width, height, fps, codec_args=("-c:v", "libx264", "-pix_fmt", "yuv420p"), max_pending=4, ffmpeg="ffmpeg"):
+		self.file = file
+		self.width = width
+		self.height = height
+		self.process = subprocess.Popen([
+			ffmpeg, "-y", "-loglevel", "error",
+			"-f", "rawvideo", "-pix_fmt", "rgb24", "-video_size", f"{width}x{height}", "-framerate", str(fps), "-i", "-",
+			*codec_args, file
+		], stdin=subprocess.PIPE)
+		self.encoder = ImageWriter()
+		super().__init__(1, max_pending)
+
+	def run(self, img):
+		try:
+			self.process.stdin.write(self.encoder.encode(img, drop_alpha=True))
+		except BrokenPipeError:
+			raise RuntimeError(f"ffmpeg exited with code {self.process.wait()} while writing {self.file}.") from None
+
+	def write(self, img):
+		if img.shape[0] != self.height or img.shape[1] != self.width or img.shape[2] < 3:
+			raise ValueError(f"Expected a {self.width}x{self.height} RGB(A) frame, got shape {img.shape}.")
+		self._put(img)
+
+	def close(self):
+		if self.closed:
+			return
+		try:
+			super().close()
+		finally:
+			try:
+				self.process.stdin.close()
+			except BrokenPipeError:
+				pass
+			returncode = self.process.wait()
+		if returncode != 0:
+			raise RuntimeError(f"ffmpeg exited with code {returncode} while writing {self.file}.")
+
+class ImageCache:
+	# Least-recently-used cache of decoded images, bounded by their total size in bytes.
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.n_bytes = 0
+		self.images = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			img = self.images.get(key)
+			if img is not None:
+				self.images.move_to_end(key)
+			return img
+
+	def put(self, key, img):
+		if img.nbytes > self.max_bytes:
+			return
+		with self.lock:
+			if key in self.images:
+				self.n_bytes -= self.images.pop(key).nbytes
+			self.images[key] = img
+			self.n_bytes += img.nbytes
+			while self.n_bytes > self.max_bytes:
+				_, evicted = self.images.popitem(last=False)
+				self.n_bytes -= evicted.nbytes
+
+	def clear(self):
+		with self.lock:
+			self.images.clear()
+			self.n_bytes = 0
+
+IMAGE_CACHE = ImageCache(int(os.environ.get("NGP_IMAGE_CACHE_BYTES", 4 * 2**30)))
+
+def image_cache_key(file, **options):
+	# Identifies a decoded image by its path, modification time, size and decode options.
+	stat = os.stat(file)
+	return (os.path.realpath(file), stat.st_mtime_ns, stat.st_size, tuple(sorted(options.items())))
+
+def _disk_cache_path(disk_cache_dir, key):
+	digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+	return os.path.join(disk_cache_dir, digest)
+
+def _read_disk_cache(stem):
+	# The channel count is part of the file name, because '.bin' files always store RGBA.
+	for channels in (4, 3, 2, 1):
+		file = f"{stem}_{channels}.bin"
+		if os.path.exists(file):
+			return read_image(file)[...,:channels]
+	return None
+
+def _write_disk_cache(stem, img):
+	os.makedirs(os.path.dirname(stem), exist_ok=True)
+	file = f"{stem}_{img.shape[2]}.bin"
+	tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp.bin"
+	write_image(tmp_file, img)
+	os.replace(tmp_file, file)
+
+def load_image(file, cache=True, disk_cache_dir=None, dtype=np.float32, scale=1):
+	# read_image() backed by IMAGE_CACHE and, optionally, by decoded fp16 '.bin'
+	# copies in disk_cache_dir that are shared between processes. With a disk cache,
+	# values are always rounded to fp16, whether or not it was hit. The returned
+	# array is read-only, because it may be shared with other callers.
+	key = image_cache_key(file, dtype=np.dtype(dtype).str, scale=scale)
+	if cache:
+		img = IMAGE_CACHE.get(key)
+		if img is not None:
+			return img
+
+	img = None
+	if disk_cache_dir:
+		stem = _disk_cache_path(disk_cache_dir, key)
+		img = _read_disk_cache(stem)
+	if img is None:
+		img = read_image(file, scale=scale)
+		if disk_cache_dir:
+			_write_disk_cache(stem, img)
+			# Match what a later disk cache hit returns
+			img = img.astype(np.float16)
+
+	img = np.ascontiguousarray(img, dtype=dtype)
+	img.flags.writeable = False
+	if cache:
+		IMAGE_CACHE.put(key, img)
+	return img
+
+def load_images(paths, workers=None, cache=True, disk_cache_dir=None, dtype=np.float32, scale=1):
+	# Decodes many images in parallel into linear, premultiplied float arrays,
+	# returned in the order of `paths`. See load_image() for the caching behavior.
+	paths = [str(p) for p in paths]
+	workers = workers or min(len(paths), os.cpu_count() or 1) or 1
+	if workers == 1:
+		return [load_image(p, cache, disk_cache_dir, dtype, scale) for p in paths]
+	return [future.result() for future in prefetch_images(paths, workers, cache, disk_cache_dir, dtype, scale)]
+
+def prefetch_images(paths, workers=None, cache=True, disk_cache_dir=None, dtype=np.float32, scale=1):
+	# Like load_images(), but returns immediately with one future per path, so that
+	# the caller can start working on the first images while the rest are decoded.
+	paths = [str(p) for p in paths]
+	workers = workers or min(len(paths), os.cpu_count() or 1) or 1
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+	futures = [executor.submit(load_image, p, cache, disk_cache_dir, dtype, scale) for p in paths]
+	# The workers exit once all images are loaded
+	executor.shutdown(wait=False)
+	return futures
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".exr", ".bin"]
+
+def resolve_image_path(path):
+	# Transforms files may reference images without extension, e.g. the test views
+	# of the synthetic NeRF scenes.
+	if os.path.isfile(path):
+		return path
+	for ext in IMAGE_EXTENSIONS:
+		if os.path.isfile(path + ext):
+			return path + ext
+	raise FileNotFoundError(f"Image {path} does not exist.")
+
+def frame_image_paths(transforms, transforms_path):
+	# Paths of the images of a NeRF transforms dict, in the order of its frames.
+	data_dir = os.path.dirname(transforms_path)
+	return [resolve_image_path(os.path.join(data_dir, frame["file_path"])) for frame in transforms["frames"]]
+
+def composite_background(img, background_color, exposure=0.0, srgb_blending=False):
+	# Composites a linear, premultiplied image over background_color and applies
+	# the exposure, like the testbed does when rendering ground truth. As with
+	# testbed.background_color, the color is sRGB. srgb_blending blends in sRGB
+	# instead of linear space, which the testbed does when its color_space is SRGB
+	# (--nerf_compatibility). Returns a linear RGBA copy.
+	background_color = np.asarray(background_color, dtype=img.dtype)
+	rgb = img[...,0:3]
+	alpha = img[...,3:4] if img.shape[2] == 4 else np.ones(img.shape[:2] + (1,), dtype=img.dtype)
+	if srgb_blending:
+		with np.errstate(divide="ignore", invalid="ignore"):
+			rgb = np.where(alpha > 0, linear_to_srgb(rgb / alpha) * alpha, 0)
+		background_rgb = background_color[0:3]
+	else:
+		background_rgb = srgb_to_linear(background_color[0:3])
+	weight = (1 - alpha) * background_color[3]
+	out = np.empty(img.shape[:2] + (4,), dtype=img.dtype)
+	out[...,0:3] = rgb + weight * background_rgb
+	if srgb_blending:
+		out[...,0:3] = srgb_to_linear(out[...,0:3])
+	out[...,0:3] *= 2**exposure
+	out[...,3:4] = alpha + weight
+	return out
+
+def check_disk_reference(ref, rendered, tolerance=1/255):
+	# Compares a reference read from disk and composited with composite_background()
+	# against the testbed's ground-truth render of the same view, and warns if they
+	# differ by more than tolerance on average. Returns the mean absolute difference.
+	error = float(np.mean(np.abs(ref[...,0:3] - rendered[...,0:3])))
+	if error > tolerance:
+		print(f"Warning: references read from disk differ from the rendered ground truth by {error:.4g} on average; metrics will not match those against rendered references.")
+	return error
+
+def _smallest(values, k, step=64):
+	# The k smallest values, in linear time. Only the values below a threshold taken
+	# from a strided sample are partitioned, rather than the whole array, unless the
+	# sample turns out not to be representative.
+	if values.size > 16 * step and k * step < values.size:
+		sample = values[::step]
+		j = min(2 * (k // step) + 8, sample.size - 1)
+		threshold = np.partition(sample, j)[j]
+		below = values[values < threshold]
+		if below.size >= k:
+			return np.partition(below, k - 1)[:k]
+		# Ties at the threshold, e.g. many pixels without error
+		if np.count_nonzero(values <= threshold) >= k:
+			return np.concatenate((below, np.full(k - below.size, threshold)))
+	return np.partition(values, k - 1)[:k]
 
 def trim(error, skip=0.000001):
-	error = np.sort(error.flatten())
+	# Mean without the skip fraction of smallest and largest values, which are
+	# selected rather than sorted.
+	error = error.ravel()
 	size = error.size
 	skip = int(skip * size)
-	return error[skip:size-skip].mean()
+	if skip == 0:
+		return error.mean()
+	return (np.sum(error) - np.sum(_smallest(error, skip)) + np.sum(_smallest(-error, skip))) / (size - 2 * skip)
+
+class ErrorHistogram:
+	# Streaming statistics of nonnegative per-pixel errors over any number of images,
+	# in memory independent of their size. Values are counted in bins of equal
+	# width in log space between min_value and max_value, each holding its count and
+	# sum; smaller values (including 0) and larger ones fall into one extra bin each.
+	# Means and min/max are exact; percentiles and trimmed means are accurate to
+	# within a bin, i.e. a relative error of 10**(1 / bins_per_decade) - 1.
+	def __init__(self, min_value=1e-10, max_value=1e6, bins_per_decade=128):
+		self.log_min = np.log10(min_value)
+		self.bins_per_decade = bins_per_decade
+		self.n_bins = int(np.ceil((np.log10(max_value) - self.log_min) * bins_per_decade))
+		self.counts = np.zeros(self.n_bins + 2)
+		self.sums = np.zeros(self.n_bins + 2)
+		self.min = np.inf
+		self.max = -np.inf
+		# add() may be called from several evaluation threads
+		self.lock = threading.Lock()
+
+	@property
+	def min_value(self):
+		return 10.0 ** self.log_min
+
+	@property
+	def max_value(self):
+		return 10.0 ** (self.log_min + self.n_bins / self.bins_per_decade)
+
+	@property
+	def count(self):
+		return self.counts.sum()
+
+	@property
+	def mean(self):
+		return self.sums.sum() / self.count
+
+	def add(self, errors, weights=None):
+		# weights, if given, is broadcast against errors, e.g. a mask.
+		errors = np.asarray(errors, dtype=np.float64)
+		if weights is not None:
+			weights = np.broadcast_to(weights, errors.shape).ravel()
+			keep = weights > 0
+			errors, weights = errors.ravel()[keep], weights[keep]
+		errors = errors.ravel()
+		finite = np.isfinite(errors)
+		errors = errors[finite]
+		weights = None if weights is None else weights[finite]
+		if errors.size == 0:
+			return
+		with np.errstate(divide="ignore", invalid="ignore"):
+			index = np.floor((np.log10(errors) - self.log_min) * self.bins_per_decade)
+		index = np.clip(np.nan_to_num(index, nan=-1, neginf=-1), -1, self.n_bins).astype(np.intp) + 1
+		counts = np.bincount(index, weights=weights, minlength=self.n_bins + 2)
+		sums = np.bincount(index, weights=errors if weights is None else errors * weights, minlength=self.n_bins + 2)
+		with self.lock:
+			self.counts += counts
+			self.sums += sums
+			self.min = min(self.min, errors.min())
+			self.max = max(self.max, errors.max())
+
+	def merge(self, other):
+		if (other.log_min, other.bins_per_decade, other.n_bins) != (self.log_min, self.bins_per_decade, self.n_bins):
+			raise ValueError("Only histograms with the same bins can be merged.")
+		self.counts += other.counts
+		self.sums += other.sums
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+		return self
+
+	def _bin_edges(self, index):
+		# Bin 0 holds the values below min_value and the last bin those above max_value.
+		if index == 0:
+			return min(self.min, self.min_value), self.min_value
+		elif index == self.n_bins + 1:
+			return self.max_value, max(self.max, self.max_value)
+		return 10.0 ** (self.log_min + (index - 1) / self.bins_per_decade), 10.0 ** (self.log_min + index / self.bins_per_decade)
+
+	def percentile(self, q):
+		# q in [0, 100], interpolated geometrically within the bin it falls into.
+		target = q / 100 * self.count
+		cumulative = np.cumsum(self.counts)
+		index = min(int(np.searchsorted(cumulative, target)), self.n_bins + 1)
+		while self.counts[index] == 0 and index > 0:
+			index -= 1
+		fraction = (target - (cumulative[index] - self.counts[index])) / self.counts[index] if self.counts[index] > 0 else 0
+		lo, hi = self._bin_edges(index)
+		value = lo + fraction * (hi - lo) if lo <= 0 or index in (0, self.n_bins + 1) else lo * (hi / lo) ** fraction
+		return float(np.clip(value, self.min, self.max))
+
+	def trimmed_mean(self, skip=0.000001):
+		# Like trim(), assuming the values within a bin have their mean as average.
+		count = self.count
+		lo, hi = skip * count, (1 - skip) * count
+		end = np.cumsum(self.counts)
+		start = end - self.counts
+		kept = np.clip(np.minimum(end, hi) - np.maximum(start, lo), 0, None)
+		fraction = np.divide(kept, self.counts, out=np.zeros_like(kept), where=self.counts > 0)
+		return np.sum(fraction * self.sums) / (hi - lo)
+
+	def summary(self, percentiles=(1, 5, 50, 95, 99), skip=0.000001):
+		result = {"count": self.count, "mean": self.mean, "trimmed_mean": self.trimmed_mean(skip), "min": self.min, "max": self.max}
+		result.update({f"p{q}": self.percentile(q) for q in percentiles})
+		return {k: float(v) for k, v in result.items()}
 
 def luminance(a):
-	return 0.2126 * a[:,:,0] + 0.7152 * a[:,:,1] + 0.0722 * a[:,:,2]
-
-def SSIM(a, b):
-	def blur(a):
-		k = np.array([0.120078, 0.233881, 0.292082, 0.233881, 0.120078])
-		x = convolve1d(a, k, axis=0)
-		return convolve1d(x, k, axis=1)
-	a = luminance(a)
-	b = luminance(b)
-	mA = blur(a)
-	mB = blur(b)
-	sA = blur(a*a) - mA**2
-	sB = blur(b*b) - mB**2
-	sAB = blur(a*b) - mA*mB
+	return 0.2126 * a[...,0] + 0.7152 * a[...,1] + 0.0722 * a[...,2]
+
+SSIM_KERNEL = np.array([0.120078, 0.233881, 0.292082, 0.233881, 0.120078])
+
+# Per-scale exponents of MS-SSIM (Wang et al. 2003); the number of weights is the number of scales.
+MS_SSIM_WEIGHTS = np.array([0.0448, 0.2856, 0.3001, 0.2363, 0.1333])
+
+SSIM_MODES = ["luminance", "channels"]
+
+def ssim_blur(a, kernel=SSIM_KERNEL):
+	# Blurs the last two (spatial) axes, so stacks of images are blurred independently.
+	x = convolve1d(a, kernel, axis=-2)
+	return convolve1d(x, kernel, axis=-1)
+
+def ssim_planes(a, mode="luminance"):
+	# (..., H, W, C) images as the planes SSIM is computed on: (..., H, W) luminance,
+	# or (..., 3, H, W) for the RGB channels separately.
+	if mode == "luminance":
+		return luminance(a)
+	elif mode == "channels":
+		return np.moveaxis(a[...,:3], -1, -3)
+	raise ValueError(f"Unknown SSIM mode: {mode}. Must be one of {SSIM_MODES}.")
+
+def ssim_moments(a, b, kernel=SSIM_KERNEL):
+	# The five local statistics of a pair of planes, blurred together in one pass.
+	return tuple(ssim_blur(np.stack((a, b, a*a, b*b, a*b)), kernel))
+
+def ssim_terms(mA, mB, mAA, mBB, mAB):
+	# The luminance and contrast-structure terms, whose product is SSIM.
+	sA = mAA - mA**2
+	sB = mBB - mB**2
+	sAB = mAB - mA*mB
 	c1 = 0.01**2
 	c2 = 0.03**2
 	p1 = (2.0*mA*mB + c1)/(mA*mA + mB*mB + c1)
 	p2 = (2.0*sAB + c2)/(sA + sB + c2)
-	error = p1 * p2
-	return error
+	return p1, p2
+
+def ssim_from_moments(mA, mB, mAA, mBB, mAB):
+	p1, p2 = ssim_terms(mA, mB, mAA, mBB, mAB)
+	return p1 * p2
+
+def ssim_downsample(a):
+	# Halves the last two axes by averaging 2x2 blocks; odd trailing rows and columns are dropped.
+	h = a.shape[-2] // 2 * 2
+	w = a.shape[-1] // 2 * 2
+	return 0.25 * (a[...,0:h:2,0:w:2] + a[...,1:h:2,0:w:2] + a[...,0:h:2,1:w:2] + a[...,1:h:2,1:w:2])
+
+def ssim_pyramid(a, b, scales=1, kernel=SSIM_KERNEL, axis=None, mask=None, histogram=None):
+	# Mean SSIM and mean contrast-structure term of planes a and b at each level of a
+	# 2x image pyramid, reduced over `axis`. Returns two arrays with a leading axis of
+	# length `scales`; index 0 is the full-resolution SSIM. If given, mask weighs the
+	# means and is downsampled along with the planes, and histogram accumulates the
+	# full-resolution 1 - SSIM.
+	if min(a.shape[-2:]) >> (scales - 1) < len(kernel):
+		raise ValueError(f"Images of {a.shape[-1]}x{a.shape[-2]} pixels are too small for {scales} SSIM scales.")
+	if mask is not None and mask.ndim < a.ndim:
+		mask = np.expand_dims(mask, -3)
+	ssim = []
+	cs = []
+	for scale in range(scales):
+		if scale > 0:
+			a = ssim_downsample(a)
+			b = ssim_downsample(b)
+			if mask is not None:
+				mask = ssim_downsample(mask)
+		l, c = ssim_terms(*ssim_moments(a, b, kernel))
+		ssim_map = l * c
+		for x in (ssim_map, c):
+			x[np.logical_not(np.isfinite(x))] = 0
+		ssim.append(masked_mean(ssim_map, mask, axis))
+		cs.append(masked_mean(c, mask, axis))
+		if histogram is not None and scale == 0:
+			histogram.add(1 - ssim_map, mask)
+	return np.array(ssim), np.array(cs)
+
+def ms_ssim_from_pyramid(ssim, cs, weights=MS_SSIM_WEIGHTS):
+	# Negative terms are clamped to 0, as their fractional powers are undefined.
+	weights = np.reshape(weights, (-1,) + (1,) * (np.ndim(ssim) - 1))
+	return np.prod(np.maximum(cs[:-1], 0) ** weights[:-1], axis=0) * np.maximum(ssim[-1], 0) ** weights[-1]
+
+def SSIM(a, b, dtype=None, mode="luminance"):
+	# dtype=np.float32 computes in single precision; the mean SSIM then stays within
+	# 1e-6 of the float64 result. mode is one of SSIM_MODES; "channels" returns
+	# a (3, H, W) map.
+	if dtype is not None:
+		a = a.astype(dtype, copy=False)
+		b = b.astype(dtype, copy=False)
+	return ssim_from_moments(*ssim_moments(ssim_planes(a, mode), ssim_planes(b, mode)))
+
+def MS_SSIM(a, b, dtype=None, mode="luminance", weights=MS_SSIM_WEIGHTS, mask=None):
+	# Multi-scale SSIM of two (H, W, C) images, one scale per weight. mask, if
+	# given, is an (H, W) weight of each pixel; see as_mask().
+	if dtype is not None:
+		a = a.astype(dtype, copy=False)
+		b = b.astype(dtype, copy=False)
+	ssim, cs = ssim_pyramid(ssim_planes(a, mode), ssim_planes(b, mode), len(weights), mask=mask)
+	return ms_ssim_from_pyramid(ssim, cs, weights)
 
 def L1(img, ref):
 	return np.abs(img - ref)
@@ -223,7 +1105,68 @@ def RSE(img, ref):
 def rgb_mean(img):
 	return np.mean(img, axis=2)
 
-def compute_error_img(metric, img, ref):
+def as_mask(mask):
+	# Per-pixel weights in [0, 1] of an (H, W) mask, or of the alpha channel of an
+	# (H, W, 4) image; other multi-channel masks use their first channel. Integer
+	# masks, e.g. the 0/255 PNGs of create_masks_from_annotations.py, are normalized.
+	mask = np.asarray(mask)
+	if mask.ndim == 3:
+		mask = mask[...,3] if mask.shape[2] == 4 else mask[...,0]
+	if mask.dtype == bool:
+		return mask.astype(np.float32)
+	if np.issubdtype(mask.dtype, np.integer):
+		return mask.astype(np.float32) / np.iinfo(mask.dtype).max
+	return mask.astype(np.float32, copy=False)
+
+def read_mask(file):
+	return as_mask(read_image_imageio_raw(file))
+
+def find_mask_file(mask_dir, image_file):
+	# Masks are named after their image, "<image file name>.png", as written by
+	# create_masks_from_annotations.py. Images may be referenced without extension.
+	name = os.path.basename(image_file)
+	for candidate in (name + ".png", os.path.splitext(name)[0] + ".png"):
+		path = os.path.join(mask_dir, candidate)
+		if os.path.isfile(path):
+			return path
+	raise FileNotFoundError(f"No mask for {image_file} in {mask_dir}")
+
+def mask_bbox(mask, margin=0, align=1):
+	# Bounding box (y0, y1, x0, x1) of the nonzero pixels of the last two axes of
+	# mask, grown by margin pixels and with its origin aligned down to a multiple of align.
+	rows = np.flatnonzero(np.any(mask, axis=tuple(range(mask.ndim - 2)) + (mask.ndim - 1,)))
+	cols = np.flatnonzero(np.any(mask, axis=tuple(range(mask.ndim - 1))))
+	if rows.size == 0:
+		raise ValueError("The mask is empty.")
+	h, w = mask.shape[-2:]
+	y0 = max(rows[0] - margin, 0) // align * align
+	x0 = max(cols[0] - margin, 0) // align * align
+	return y0, min(rows[-1] + 1 + margin, h), x0, min(cols[-1] + 1 + margin, w)
+
+def metric_crop_margin(metric):
+	# (margin, align) of the crop to a mask's bounding box, such that the metric's
+	# filters see the same neighborhood of each masked pixel as in the full image.
+	if metric in ("SSIM", "MS-SSIM"):
+		# Each pyramid level doubles the footprint of the blur, and the crop must not
+		# change which pixels are averaged together when downsampling.
+		levels = len(MS_SSIM_WEIGHTS) if metric == "MS-SSIM" else 1
+		return (len(SSIM_KERNEL) // 2 + 1) << (levels - 1), 1 << (levels - 1)
+	elif metric in FLIP_METRICS:
+		return flip.filter_radius(flip_pixels_per_degree()), 1
+	return 0, 1
+
+def masked_mean(x, mask=None, axis=None):
+	# Mean of x weighted by mask, which is broadcast against x.
+	if mask is None:
+		return np.mean(x, axis=axis, dtype=np.float64)
+	return np.sum(x * mask, axis=axis, dtype=np.float64) / np.sum(np.broadcast_to(mask, x.shape), axis=axis, dtype=np.float64)
+
+def compute_error_img(metric, img, ref, dtype=None):
+	# dtype, if given, is the precision the metric is computed in. FLIP defaults to float64
+	# otherwise; see flip.compute_flip() and SSIM() for the accuracy of np.float32.
+	if dtype is not None:
+		img = img.astype(dtype)
+		ref = ref.astype(dtype, copy=False)
 	img[np.logical_not(np.isfinite(img))] = 0
 	img = np.maximum(img, 0.)
 	if metric == "MAE":
@@ -244,26 +1187,579 @@ def compute_error_img(metric, img, ref):
 		return RSE(np.clip(img, 0, 100), np.clip(ref, 0, 100))
 	elif metric == "SSIM":
 		return SSIM(np.clip(img, 0.0, 1.0), np.clip(ref, 0.0, 1.0))
-	elif metric in ["FLIP", "\FLIP"]:
-		# Set viewing conditions
-		monitor_distance = 0.7
-		monitor_width = 0.7
-		monitor_resolution_x = 3840
-		# Compute number of pixels per degree of visual angle
-		pixels_per_degree = monitor_distance * (monitor_resolution_x / monitor_width) * (np.pi / 180)
-
-		ref_srgb = np.clip(flip.color_space_transform(ref, "linrgb2srgb"), 0, 1)
-		img_srgb = np.clip(flip.color_space_transform(img, "linrgb2srgb"), 0, 1)
-		result = flip.compute_flip(flip.utils.HWCtoCHW(ref_srgb), flip.utils.HWCtoCHW(img_srgb), pixels_per_degree)
-		assert np.isfinite(result).all()
+	elif metric in FLIP_METRICS:
+		result = np.empty((1, img.shape[0], img.shape[1]), dtype=dtype or np.float64)
+		for y0, y1, x0, x1, error in iter_flip_error_tiles(img, ref, dtype):
+			result[:, y0:y1, x0:x1] = error
 		return flip.utils.CHWtoHWC(result)
 
 	raise ValueError(f"Unknown metric: {metric}.")
 
-def compute_error(metric, img, ref):
-	metric_map = compute_error_img(metric, img, ref)
+FLIP_METRICS = ["FLIP", "\FLIP"]
+
+# Images are split into tiles of this size when computing FLIP, which bounds the
+# memory used by its full-resolution float64 intermediates. The result is exact.
+FLIP_TILE_SIZE = 512
+
+def flip_pixels_per_degree():
+	# Set viewing conditions
+	monitor_distance = 0.7
+	monitor_width = 0.7
+	monitor_resolution_x = 3840
+	# Compute number of pixels per degree of visual angle
+	return monitor_distance * (monitor_resolution_x / monitor_width) * (np.pi / 180)
+
+def _linrgb_chw_to_srgb(x):
+	return np.clip(flip.color_space_transform(flip.utils.CHWtoHWC(x), "linrgb2srgb"), 0, 1).transpose(2, 0, 1)
+
+def iter_flip_error_tiles(img, ref, dtype=None):
+	# FLIP error of linear HWC images, tile by tile; see flip.iter_flip_tiles().
+	# The sRGB conversion is applied per tile as well.
+	tiles = flip.iter_flip_tiles(flip.utils.HWCtoCHW(ref), flip.utils.HWCtoCHW(img), flip_pixels_per_degree(), FLIP_TILE_SIZE, preprocess=_linrgb_chw_to_srgb, dtype=dtype or np.float64)
+	for y0, y1, x0, x1, error in tiles:
+		assert np.isfinite(error).all()
+		yield y0, y1, x0, x1, error
+
+def compute_error(metric, img, ref, dtype=None, mask=None, histogram=None):
+	# mask, if given, restricts the metric to a region of interest: the mean is
+	# weighted by as_mask(mask), and the images are cropped to the mask's bounding
+	# box first, so that the cost scales with the masked area. histogram, an
+	# ErrorHistogram, accumulates the per-pixel error (1 - SSIM for SSIM) of metrics
+	# that have one.
+	if mask is not None:
+		mask = as_mask(mask)
+		y0, y1, x0, x1 = mask_bbox(mask, *metric_crop_margin(metric))
+		img, ref, mask = img[y0:y1, x0:x1], ref[y0:y1, x0:x1], mask[y0:y1, x0:x1]
+	if metric == "MS-SSIM":
+		# A single value rather than a per-pixel map
+		img = img.copy()
+		img[np.logical_not(np.isfinite(img))] = 0
+		return MS_SSIM(np.clip(img, 0.0, 1.0), np.clip(ref, 0.0, 1.0), dtype, mask=mask)
+	if metric in FLIP_METRICS:
+		# Accumulate the mean tile by tile instead of keeping the error map.
+		img[np.logical_not(np.isfinite(img))] = 0
+		img = np.maximum(img, 0.)
+		total = 0
+		for y0, y1, x0, x1, error in iter_flip_error_tiles(img, ref, dtype):
+			weights = None if mask is None else mask[y0:y1, x0:x1]
+			total += np.sum(error if weights is None else error * weights, dtype=np.float64)
+			if histogram is not None:
+				histogram.add(error, weights)
+		return total / (img.shape[0] * img.shape[1] if mask is None else np.sum(mask, dtype=np.float64))
+	if metric == "MtRSE" and mask is not None:
+		return trim(compute_error_img("MRSE", img, ref, dtype)[mask > 0])
+	metric_map = compute_error_img(metric, img, ref, dtype)
+	if np.ndim(metric_map) == 0:
+		# Metrics such as MtRSE that reduce to a single value
+		return metric_map
 	metric_map[np.logical_not(np.isfinite(metric_map))] = 0
 	if len(metric_map.shape) == 3:
 		metric_map = np.mean(metric_map, axis=2)
-	mean = np.mean(metric_map)
+	if histogram is not None:
+		histogram.add(1 - metric_map if metric == "SSIM" else metric_map, mask)
+	mean = masked_mean(metric_map, mask)
 	return mean
+
+class MetricEngine:
+	# Computes several metrics over many image pairs at once. Images are linear
+	# (N, H, W, C) stacks, as returned by testbed.render(); like the evaluation
+	# loops, metrics are computed on the clipped sRGB encoding of the RGB channels.
+	# Intermediates are shared between metrics: the sRGB images are computed once,
+	# the squared error serves both MSE and PSNR, and the five SSIM moments of a
+	# whole batch are blurred in a single pair of separable convolutions. MS-SSIM
+	# reuses the full-resolution SSIM level of its pyramid.
+	# Other metrics are delegated to compute_error(), on the sRGB images, except for
+	# FLIP_METRICS, which do their own sRGB encoding and get the linear RGB ones. With masks, each batch is
+	# cropped to the union of its masks' bounding boxes and means are weighted by the masks.
+	# With histograms=True, the per-pixel errors of all images are also accumulated
+	# into one ErrorHistogram per metric that has them; see error_statistics().
+	STATISTICS = ("mean", "min", "max")
+
+	def __init__(self, metrics=("MSE", "PSNR", "SSIM"), batch_size=8, dtype=None, histograms=False):
+		# dtype, if given, is the precision the metrics are computed in.
+		self.metrics = tuple(metrics)
+		self.batch_size = batch_size
+		self.compute_dtype = dtype
+		self.dtype = np.dtype([(m, np.float64) for m in self.metrics])
+		self.histograms = {m: ErrorHistogram() for m in self.metrics if m not in ("PSNR", "MS-SSIM", "MtRSE")} if histograms else {}
+
+	def prepare(self, imgs):
+		if self.compute_dtype is not None:
+			imgs = imgs.astype(self.compute_dtype, copy=False)
+		srgb = np.clip(linear_to_srgb(imgs[...,:3]), 0.0, 1.0)
+		srgb[np.logical_not(np.isfinite(srgb))] = 0
+		return srgb
+
+	def compute(self, imgs, refs, masks=None):
+		# Per-image results for a stack of images and references, as a structured array.
+		# masks, if given, is a stack of masks of the images; see as_mask().
+		imgs = np.asarray(imgs)
+		refs = np.asarray(refs)
+		if imgs.ndim == 3:
+			imgs, refs = imgs[np.newaxis], refs[np.newaxis]
+			masks = None if masks is None else [masks]
+		if imgs.shape != refs.shape:
+			raise ValueError(f"imgs and refs must have the same shape; {imgs.shape} vs {refs.shape}")
+		if masks is not None:
+			masks = np.stack([as_mask(m) for m in masks])
+			if masks.shape != imgs.shape[:3]:
+				raise ValueError(f"masks must match the images' resolution; {masks.shape} vs {imgs.shape[:3]}")
+		results = np.empty(imgs.shape[0], dtype=self.dtype)
+		for i in range(0, imgs.shape[0], self.batch_size):
+			batch_masks = None if masks is None else masks[i:i+self.batch_size]
+			self._compute_batch(imgs[i:i+self.batch_size], refs[i:i+self.batch_size], results[i:i+self.batch_size], batch_masks)
+		return results
+
+	def compute_pair(self, img, ref, mask=None):
+		return self.compute(img[np.newaxis], ref[np.newaxis], None if mask is None else [mask])[0]
+
+	def compute_pairs(self, pairs):
+		# Like compute(), but for an iterable of (img, ref) pairs or (img, ref, mask)
+		# triples. Consecutive pairs of the same shape are batched; images may differ
+		# in resolution.
+		results = []
+		batch = []
+		for img, ref, *mask in pairs:
+			if batch and (len(batch) == self.batch_size or batch[0][0].shape != img.shape or bool(batch[0][2]) != bool(mask)):
+				results.append(self._compute_stacked(batch))
+				batch = []
+			batch.append((img, ref, mask))
+		if batch:
+			results.append(self._compute_stacked(batch))
+		return np.concatenate(results) if results else np.empty(0, dtype=self.dtype)
+
+	def _compute_stacked(self, batch):
+		masks = [p[2][0] for p in batch] if batch[0][2] else None
+		return self.compute(np.stack([p[0] for p in batch]), np.stack([p[1] for p in batch]), masks)
+
+	def _compute_batch(self, imgs, refs, out, masks=None):
+		if masks is not None:
+			margins = [metric_crop_margin(m) for m in self.metrics]
+			y0, y1, x0, x1 = mask_bbox(masks, max(m[0] for m in margins), max(m[1] for m in margins))
+			imgs, refs, masks = imgs[:, y0:y1, x0:x1], refs[:, y0:y1, x0:x1], masks[:, y0:y1, x0:x1]
+			if not np.all(np.any(masks, axis=(1, 2))):
+				raise ValueError("The mask is empty.")
+		A = self.prepare(imgs)
+		R = self.prepare(refs)
+		if "MSE" in self.metrics or "PSNR" in self.metrics:
+			l2 = np.mean((A - R)**2, axis=-1)
+			mse = masked_mean(l2, masks, axis=(1, 2))
+			if "MSE" in self.histograms:
+				self.histograms["MSE"].add(l2, masks)
+			if "MSE" in self.metrics:
+				out["MSE"] = mse
+			if "PSNR" in self.metrics:
+				out["PSNR"] = mse2psnr(mse)
+		if "SSIM" in self.metrics or "MS-SSIM" in self.metrics:
+			scales = len(MS_SSIM_WEIGHTS) if "MS-SSIM" in self.metrics else 1
+			ssim, cs = ssim_pyramid(luminance(A), luminance(R), scales, axis=(1, 2), mask=masks, histogram=self.histograms.get("SSIM"))
+			if "SSIM" in self.metrics:
+				out["SSIM"] = ssim[0]
+			if "MS-SSIM" in self.metrics:
+				out["MS-SSIM"] = ms_ssim_from_pyramid(ssim, cs)
+		for metric in self.metrics:
+			if metric not in ("MSE", "PSNR", "SSIM", "MS-SSIM"):
+				I, J = (imgs[...,:3], refs[...,:3]) if metric in FLIP_METRICS else (A, R)
+				out[metric] = [compute_error(metric, np.copy(I[i]), J[i], self.compute_dtype, None if masks is None else masks[i], self.histograms.get(metric)) for i in range(A.shape[0])]
+
+	def summarize(self, results):
+		# Aggregates per-image results into one record per statistic in STATISTICS.
+		dtype = np.dtype([("statistic", "U8")] + self.dtype.descr)
+		summary = np.zeros(len(self.STATISTICS), dtype=dtype)
+		summary["statistic"] = self.STATISTICS
+		for metric in self.metrics:
+			values = results[metric]
+			if values.size > 0:
+				summary[metric] = [np.mean(values), np.min(values), np.max(values)]
+		return summary
+
+	def error_statistics(self, percentiles=(1, 5, 50, 95, 99)):
+		# Per-pixel error statistics over all images so far, keyed by metric;
+		# SSIM is reported as its error, 1 - SSIM.
+		return {("1-SSIM" if m == "SSIM" else m): h.summary(percentiles) for m, h in self.histograms.items() if h.count > 0}
+
+def render_adaptive(render, ref, max_spp, psnr_tolerance=0.05, ssim_tolerance=0.0005, mask=None):
+	# Renders with render(spp) at 1, 2, 4, ... samples per pixel until PSNR and SSIM
+	# against ref change by less than the tolerances between consecutive renders, or
+	# max_spp is reached. Each render starts from scratch, since the testbed's sample
+	# pattern restarts with every render() call; the doubling keeps the total cost
+	# below twice that of the final render. Returns the last image, its spp and the
+	# trace of (spp, PSNR, SSIM) of every render.
+	metric_engine = MetricEngine(["PSNR", "SSIM"])
+	trace = []
+	spp = 1
+	while True:
+		img = render(spp)
+		result = metric_engine.compute_pair(img, ref, mask)
+		trace.append({"spp": spp, "PSNR": float(result["PSNR"]), "SSIM": float(result["SSIM"])})
+		if len(trace) > 1 and abs(trace[-1]["PSNR"] - trace[-2]["PSNR"]) < psnr_tolerance and abs(trace[-1]["SSIM"] - trace[-2]["SSIM"]) < ssim_tolerance:
+			break
+		if spp >= max_spp:
+			break
+		spp = min(2 * spp, max_spp)
+	return img, spp, trace
+
+class EvaluationPipeline(BackgroundWorkers):
+	# Computes the metrics of rendered images on background threads while the caller
+	# renders the next ones, so that evaluation takes about as long as the slower of
+	# rendering and metrics rather than their sum. Results are ordered by the index
+	# they were submitted with, regardless of completion order.
+	def __init__(self, metric_engine, n_threads=2, max_pending=4):
+		self.metric_engine = metric_engine
+		self.results_by_index = {}
+		super().__init__(n_threads, max_pending)
+
+	def run(self, job):
+		index, img, ref, mask = job
+		if isinstance(mask, str):
+			mask = read_mask(mask)
+		result = self.metric_engine.compute_pair(img, ref, mask)
+		with self.lock:
+			self.results_by_index[index] = result
+
+	def submit(self, index, img, ref, mask=None):
+		# mask may also be the path of a mask file, which is then read by the worker.
+		self._put((index, img, ref, mask))
+
+	def completed(self):
+		# Results finished so far, in completion order; for progress reporting.
+		with self.lock:
+			return list(self.results_by_index.values())
+
+	def results(self):
+		# Waits for all submitted images and returns their results ordered by index.
+		self.flush()
+		with self.lock:
+			return np.array([self.results_by_index[i] for i in sorted(self.results_by_index)], dtype=self.metric_engine.dtype)
+
+def file_digest(file, digest=None):
+	digest = digest or hashlib.sha1()
+	with open(file, "rb") as f:
+		for chunk in iter(lambda: f.read(2**20), b""):
+			digest.update(chunk)
+	return digest
+
+class EvaluationCache:
+	# Per-image evaluation results, stored under a key that hashes everything the
+	# results depend on: the snapshot's bytes, the test transforms, the reference
+	# images and the render settings. Metrics are stored per metric, so that
+	# evaluating a different metric list only has to compute the metrics that are
+	# not cached yet. With store_images=True, the rendered images and references are
+	# kept as well, which lets new metrics be computed without rendering.
+	def __init__(self, cache_dir, store_images=False):
+		self.cache_dir = cache_dir
+		self.store_images = store_images
+
+	@staticmethod
+	def key(files, settings):
+		# files are hashed by content, settings (a JSON-serializable dict) by value.
+		digest = hashlib.sha1()
+		for file in files:
+			file_digest(file, digest)
+		digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+		return digest.hexdigest()
+
+	def _entry_dir(self, key):
+		return os.path.join(self.cache_dir, key)
+
+	def load(self, key):
+		# {"n_images": ..., "metrics": {metric: [value per image]}, "error_statistics": {...}},
+		# or None if nothing is cached under key.
+		try:
+			with open(os.path.join(self._entry_dir(key), "metrics.json")) as f:
+				return json.load(f)
+		except FileNotFoundError:
+			return None
+
+	def update(self, key, results, error_statistics=None):
+		# Adds the metrics of a structured array of per-image results to the entry.
+		entry = self.load(key) or {"n_images": len(results), "metrics": {}, "error_statistics": {}}
+		if entry["n_images"] != len(results):
+			raise ValueError(f"Cached results are for {entry['n_images']} images, not {len(results)}.")
+		entry["metrics"].update({m: results[m].tolist() for m in results.dtype.names})
+		entry["error_statistics"].update(error_statistics or {})
+		os.makedirs(self._entry_dir(key), exist_ok=True)
+		file = os.path.join(self._entry_dir(key), "metrics.json")
+		tmp_file = f"{file}.{os.getpid()}.tmp"
+		with open(tmp_file, "w") as f:
+			json.dump(entry, f, indent=2)
+		os.replace(tmp_file, file)
+		return entry
+
+	def _image_files(self, key, index):
+		return tuple(os.path.join(self._entry_dir(key), f"{name}_{index:04d}.npy") for name in ("out", "ref"))
+
+	def has_images(self, key, n_images):
+		return all(os.path.isfile(file) for i in range(n_images) for file in self._image_files(key, i))
+
+	def load_images(self, key, index):
+		# The (image, reference) pair of a test view, exactly as rendered.
+		return tuple(np.load(file) for file in self._image_files(key, index))
+
+	def save_images(self, key, index, img, ref):
+		if not self.store_images:
+			return
+		os.makedirs(self._entry_dir(key), exist_ok=True)
+		for file, x in zip(self._image_files(key, index), (img, ref)):
+			tmp_file = f"{file}.{os.getpid()}.tmp.npy"
+			np.save(tmp_file, x)
+			os.replace(tmp_file, file)
+
+	@staticmethod
+	def results(entry, metrics):
+		# The cached metrics of entry as a structured array, as MetricEngine.compute() returns.
+		results = np.empty(entry["n_images"], dtype=np.dtype([(m, np.float64) for m in metrics]))
+		for m in metrics:
+			results[m] = entry["metrics"][m]
+		return results
+
+class TrainingTelemetry:
+	# Records training progress around the testbed.frame() loop. Every stride-th
+	# frame, the training step, loss, wall time since the start and mean frame time
+	# since the previous sample are stored in a preallocated array used as a ring
+	# buffer, so that memory stays bounded on arbitrarily long runs; the oldest
+	# samples are overwritten first. Named phases, e.g. training and evaluation, are
+	# timed with phase().
+	DTYPE = np.dtype([("step", np.int64), ("loss", np.float64), ("wall_time", np.float64), ("frame_time", np.float64)])
+
+	def __init__(self, capacity=100000, stride=10, target_loss=None):
+		self.buffer = np.zeros(capacity, dtype=self.DTYPE)
+		self.stride = stride
+		self.target_loss = target_loss
+		self.n_frames = 0
+		self.n_samples = 0
+		self.phases = []
+		self.start_time = time.perf_counter()
+		self.last_sample_time = self.start_time
+		self.start_step = None
+		self.last_step = None
+		self.time_to_target_loss = None
+		self.step_at_target_loss = None
+		# Why training ended, e.g. "n_steps", "time_budget" or "early_stop"
+		self.stop_reason = None
+		# CheckpointWriter.records of the checkpoints written during training
+		self.checkpoints = []
+
+	@property
+	def elapsed(self):
+		return time.perf_counter() - self.start_time
+
+	def record(self, step, loss):
+		# Call once per frame. Returns whether a sample was taken.
+		now = time.perf_counter()
+		if self.start_step is None:
+			self.start_step = step
+		self.last_step = step
+		if self.target_loss is not None and self.time_to_target_loss is None and loss <= self.target_loss:
+			self.time_to_target_loss = now - self.start_time
+			self.step_at_target_loss = step
+		self.n_frames += 1
+		if self.n_frames % self.stride == 0:
+			self.buffer[self.n_samples % len(self.buffer)] = (step, loss, now - self.start_time, (now - self.last_sample_time) / self.stride)
+			self.n_samples += 1
+			self.last_sample_time = now
+			return True
+		return False
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.phases.append({"name": name, "start": start - self.start_time, "duration": time.perf_counter() - start})
+
+	def samples(self):
+		# The retained samples, oldest first.
+		if self.n_samples <= len(self.buffer):
+			return self.buffer[:self.n_samples].copy()
+		return np.roll(self.buffer, -(self.n_samples % len(self.buffer)))
+
+	def recent(self, n):
+		# The last n retained samples, oldest first.
+		n = min(n, self.n_samples, len(self.buffer))
+		end = self.n_samples % len(self.buffer)
+		if n <= end:
+			return self.buffer[end-n:end]
+		return np.concatenate((self.buffer[end-n:], self.buffer[:end]))
+
+	def steps_per_second(self):
+		elapsed = self.last_sample_time - self.start_time
+		if self.start_step is None or elapsed <= 0:
+			return 0.0
+		samples = self.samples()
+		last_step = samples["step"][-1] if len(samples) > 0 else self.start_step
+		return float(last_step - self.start_step) / elapsed
+
+	def summary(self):
+		return {
+			"steps": int(self.last_step - self.start_step) if self.start_step is not None else 0,
+			"frames": self.n_frames,
+			"wall_time": time.perf_counter() - self.start_time,
+			"steps_per_second": self.steps_per_second(),
+			"target_loss": self.target_loss,
+			"time_to_target_loss": self.time_to_target_loss,
+			"step_at_target_loss": self.step_at_target_loss,
+			"stop_reason": self.stop_reason,
+			"checkpoints": self.checkpoints,
+			"phases": self.phases,
+		}
+
+	def write_csv(self, file):
+		np.savetxt(file, self.samples(), delimiter=",", header=",".join(self.DTYPE.names), comments="", fmt=["%d", "%.9g", "%.6f", "%.6f"])
+
+	def write_json(self, file):
+		samples = self.samples()
+		with open(file, "w") as f:
+			json.dump({"summary": self.summary(), "samples": {name: samples[name].tolist() for name in self.DTYPE.names}}, f)
+
+	def write_chrome_trace(self, file):
+		# Chrome's trace event format, viewable in chrome://tracing or Perfetto: phases
+		# and sampled frames as duration events, loss and steps/sec as counters.
+		us = 1e6
+		events = [{"name": p["name"], "ph": "X", "ts": p["start"] * us, "dur": p["duration"] * us, "pid": 0, "tid": 0} for p in self.phases]
+		samples = self.samples()
+		for i, sample in enumerate(samples):
+			wall_time = float(sample["wall_time"])
+			frame_time = float(sample["frame_time"])
+			events.append({"name": "frame", "ph": "X", "ts": (wall_time - frame_time) * us, "dur": frame_time * us, "pid": 0, "tid": 1, "args": {"step": int(sample["step"])}})
+			events.append({"name": "loss", "ph": "C", "ts": wall_time * us, "pid": 0, "args": {"loss": float(sample["loss"])}})
+			if i > 0:
+				steps_per_second = (sample["step"] - samples[i-1]["step"]) / max(wall_time - samples[i-1]["wall_time"], 1e-9)
+				events.append({"name": "steps/sec", "ph": "C", "ts": wall_time * us, "pid": 0, "args": {"steps/sec": float(steps_per_second)}})
+		with open(file, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+	def write(self, stem, chrome_trace=False):
+		# Writes <stem>_telemetry.csv and .json, and optionally <stem>_trace.json.
+		self.write_csv(f"{stem}_telemetry.csv")
+		self.write_json(f"{stem}_telemetry.json")
+		if chrome_trace:
+			self.write_chrome_trace(f"{stem}_trace.json")
+
+class LossPlateau:
+	# Detects when the training loss stops improving, from the telemetry samples.
+	# The loss is smoothed by fitting a line to log(loss) over the last `window`
+	# samples; its slope is the relative loss change per step. Training has
+	# plateaued once the loss improved by less than `threshold` per 1000 steps for
+	# `patience` consecutive steps.
+	def __init__(self, window=100, threshold=0.005, patience=2000):
+		self.window = window
+		self.threshold = threshold
+		self.patience = patience
+		self.plateau_start = None
+		self.slope = None
+
+	def update(self, telemetry):
+		# Call when telemetry took a new sample. Returns whether training has plateaued.
+		samples = telemetry.recent(self.window)
+		if len(samples) < self.window:
+			return False
+		steps = samples["step"].astype(np.float64)
+		loss = np.log(np.maximum(samples["loss"], 1e-30))
+		if steps[-1] <= steps[0]:
+			return False
+		self.slope = np.polyfit(steps - steps[0], loss, 1)[0]
+		step = int(steps[-1])
+		if -self.slope * 1000 >= self.threshold:
+			self.plateau_start = None
+			return False
+		if self.plateau_start is None:
+			self.plateau_start = step
+		return step - self.plateau_start >= self.patience
+
+def list_checkpoints(directory):
+	# The (step, path) of the checkpoints in directory, oldest first.
+	checkpoints = []
+	for file in glob.glob(os.path.join(directory, "checkpoint_*.ingp")):
+		try:
+			step = int(os.path.basename(file)[len("checkpoint_"):-len(".ingp")])
+		except ValueError:
+			continue
+		checkpoints.append((step, file))
+	return sorted(checkpoints)
+
+def load_latest_checkpoint(testbed, directory):
+	# Loads the newest checkpoint in directory that the testbed accepts and returns
+	# its path, or None if there is none.
+	for _, file in reversed(list_checkpoints(directory)):
+		try:
+			testbed.load_snapshot(file)
+			return file
+		except RuntimeError as e:
+			print(f"Skipping checkpoint {file}: {e}")
+	return None
+
+class CheckpointWriter(BackgroundWorkers):
+	# Writes periodic training checkpoints to <directory>/checkpoint_<step>.ingp and
+	# keeps the newest `keep` of them. The training thread only serializes an
+	# uncompressed snapshot to a hidden temporary file; zlib compression, fsync and
+	# the atomic rename to the final name happen on a background thread, so a
+	# checkpoint file is either complete or absent. save() blocks while the previous
+	# checkpoint is still being compressed.
+	def __init__(self, directory, keep=3, include_optimizer_state=True, compress=True, chunk_size=1<<24):
+		self.directory = directory
+		self.keep = keep
+		self.include_optimizer_state = include_optimizer_state
+		self.compress = compress
+		self.chunk_size = chunk_size
+		# Per checkpoint: the step, how long training stalled for it and how long the
+		# background compression and write took, in seconds.
+		self.records = []
+		os.makedirs(directory, exist_ok=True)
+		# Temporary files of a run that was killed while writing a checkpoint
+		for leftover in glob.glob(os.path.join(directory, ".checkpoint_*")):
+			os.remove(leftover)
+		super().__init__(1, 1)
+
+	def run(self, job):
+		raw_file, file, record, compress = job
+		start = time.perf_counter()
+		tmp_file = os.path.join(self.directory, f".{os.path.basename(file)}.tmp")
+		try:
+			if compress:
+				# The raw snapshot is a gzip stream of stored blocks; recompress it the way
+				# save_snapshot(compress=True) would have.
+				decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+				compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+				with open(raw_file, "rb") as src, open(tmp_file, "wb") as dst:
+					for chunk in iter(lambda: src.read(self.chunk_size), b""):
+						dst.write(compressor.compress(decompressor.decompress(chunk)))
+					dst.write(compressor.compress(decompressor.flush()))
+					dst.write(compressor.flush())
+					dst.flush()
+					os.fsync(dst.fileno())
+				os.remove(raw_file)
+			else:
+				with open(raw_file, "rb+") as f:
+					os.fsync(f.fileno())
+				tmp_file = raw_file
+			os.replace(tmp_file, file)
+		finally:
+			for leftover in (raw_file, tmp_file):
+				if os.path.exists(leftover):
+					os.remove(leftover)
+		record["write_time"] = time.perf_counter() - start
+		record["bytes"] = os.path.getsize(file)
+		self.prune()
+
+	def prune(self):
+		for _, file in list_checkpoints(self.directory)[:-self.keep] if self.keep > 0 else []:
+			os.remove(file)
+
+	def save(self, testbed, compress=None):
+		# compress=False skips the recompression, e.g. to finish a last checkpoint
+		# quickly before the process is killed.
+		if self.closed:
+			raise RuntimeError("CheckpointWriter is closed.")
+		start = time.perf_counter()
+		step = testbed.training_step
+		file = os.path.join(self.directory, f"checkpoint_{step:08d}.ingp")
+		raw_file = os.path.join(self.directory, f".checkpoint_{step:08d}.raw.ingp")
+		# Wait for the previous checkpoint, so that at most one raw snapshot exists.
+		self.flush()
+		testbed.save_snapshot(raw_file, self.include_optimizer_state, False)
+		record = {"step": step, "file": file, "stall_time": time.perf_counter() - start}
+		self.records.append(record)
+		self._put((raw_file, file, record, self.compress if compress is None else compress))
+		return file
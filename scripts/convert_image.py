@@ -13,25 +13,70 @@ import common
 import numpy as np
 import os
 import PIL
+import struct
 
 def parse_args():
 	parser = argparse.ArgumentParser(description="Convert image into a different format. By default, converts to our binary fp16 '.bin' format, which helps quickly load large images.")
 	parser.add_argument("--input", default="", help="Path to the image to convert.")
 	parser.add_argument("--output", default="", help="Path to the output. Defaults to <input>.bin")
+	parser.add_argument("--tile_size", type=int, default=0, help="Write a tiled version 2 '.bin' file with this tile size. 0 writes the version 1 format read by the native loader.")
+	parser.add_argument("--compress", action="store_true", help="Compress the tiles of a version 2 '.bin' file with zlib.")
+	parser.add_argument("--strip_rows", type=int, default=256, help="Number of rows converted to float at a time when writing '.bin' files. Only '.bin' inputs are streamed; other formats are still decoded as a whole, in their stored 8/16-bit or float representation, before conversion.")
 	args = parser.parse_args()
 	return args
 
+def open_source(file):
+	# Returns the source pixels in their stored representation, without conversion to float.
+	if os.path.splitext(file)[1] == ".bin":
+		return common.read_image(file, mmap=True)
+	return common.read_image_imageio_raw(file)
+
+def convert_strip(strip, linear=False):
+	# linear: the strip comes from a '.bin' file and already holds linear, premultiplied values.
+	out = np.ones((strip.shape[0], strip.shape[1], 4), dtype=np.float16)
+	c = min(strip.shape[2], 4)
+	if linear:
+		out[...,:c] = strip[...,:c]
+	elif strip.dtype in (np.uint8, np.uint16):
+		# Decodes, linearizes and premultiplies straight into the fp16 output.
+		common.decode_srgb_image(strip[...,:c], out=out[...,:c])
+	else:
+		# Same conversion of float sources, e.g. EXR, as common.read_image().
+		out[...,:c] = common.linearize_image(strip[...,:c].astype(np.float32) / 255.0)
+	return out
+
+def write_bin_streaming(output, src, strip_rows, tile_size=0, compress=False, linear=False):
+	# Float conversion happens one strip at a time, so memory use is bounded by the
+	# source's stored representation plus a single strip.
+	h, w = src.shape[0], src.shape[1]
+	if tile_size > 0:
+		with common.TiledBinWriter(output, h, w, tile_size, compress) as writer:
+			for y in range(0, h, strip_rows):
+				writer.write_rows(convert_strip(src[y:y+strip_rows], linear))
+	else:
+		with open(output, "wb") as f:
+			f.write(struct.pack("ii", h, w))
+			for y in range(0, h, strip_rows):
+				f.write(convert_strip(src[y:y+strip_rows], linear).tobytes())
+
 if __name__ == "__main__":
 	args = parse_args()
 	PIL.Image.MAX_IMAGE_PIXELS = 10000000000
-	print(f"Loading {args.input}")
-	img = common.read_image(args.input)
-	print(f"{img.shape[1]}x{img.shape[0]} pixels, {img.shape[2]} channels")
 
 	if not args.output:
 		output = os.path.splitext(args.input)[0] + ".bin"
 	else:
 		output = args.output
 
-	print(f"Writing {output}")
-	common.write_image(output, img.astype(np.float16))
+	print(f"Loading {args.input}")
+	if os.path.splitext(output)[1] == ".bin":
+		src = open_source(args.input)
+		print(f"{src.shape[1]}x{src.shape[0]} pixels, {src.shape[2]} channels")
+		print(f"Writing {output}")
+		write_bin_streaming(output, src, args.strip_rows, args.tile_size, args.compress, os.path.splitext(args.input)[1] == ".bin")
+	else:
+		# '.bin' inputs are memory-mapped so that they are never held in memory twice.
+		img = common.read_image(args.input, mmap=True)
+		print(f"{img.shape[1]}x{img.shape[0]} pixels, {img.shape[2]} channels")
+		print(f"Writing {output}")
+		common.write_image(output, np.asarray(img, dtype=np.float32))
@@ -12,22 +12,33 @@ import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
-def render_video(resolution, numframes, snapshot, camera_path, spp, fps, exposure=0):
+def render_video(resolution, numframes, snapshot, camera_path, spp, fps, exposure=0, save_frames=False):
     # Set frames_dir to be in the same directory as the snapshot with camera path name and resolution
     snapshot_path = Path(snapshot)
     camera_path_name = Path(camera_path).stem
     frames_dir = snapshot_path.parent / f"frames_{camera_path_name}_{resolution[0]}_{resolution[1]}_{numframes}"
-    frames_dir.mkdir(exist_ok=True)  # Create frames directory if it doesn't exist
-    
+    if save_frames:
+        frames_dir.mkdir(exist_ok=True)  # Create frames directory if it doesn't exist
+
     testbed = ngp.Testbed(ngp.TestbedMode.Nerf)
     testbed.load_snapshot(snapshot)
     testbed.load_camera_path(camera_path)
 
-    for i in tqdm(list(range(min(numframes, numframes+1))), unit="frames", desc=f"Rendering video"):
-        # testbed.camera_smoothing = args.video_camera_smoothing
-        frame = testbed.render(resolution[0], resolution[1], spp, True, float(i)/numframes, float(i + 1)/numframes, fps, shutter_fraction=0.5)
-        frame_filename = frames_dir / f"{i:04d}.png"
-        common.write_image(str(frame_filename), np.clip(frame * 2**exposure, 0.0, 1.0), quality=100)
+    if not save_frames:
+        # Frames are streamed straight into ffmpeg, without touching the disk.
+        with common.VideoWriter(f"{frames_dir}.mp4", resolution[0], resolution[1], fps) as video_writer:
+            for i in tqdm(list(range(min(numframes, numframes+1))), unit="frames", desc=f"Rendering video"):
+                frame = testbed.render(resolution[0], resolution[1], spp, True, float(i)/numframes, float(i + 1)/numframes, fps, shutter_fraction=0.5)
+                video_writer.write(np.clip(frame * 2**exposure, 0.0, 1.0))
+        return
+
+    # Frames are encoded and written in the background while the next one renders.
+    with common.AsyncImageWriter() as image_writer:
+        for i in tqdm(list(range(min(numframes, numframes+1))), unit="frames", desc=f"Rendering video"):
+            # testbed.camera_smoothing = args.video_camera_smoothing
+            frame = testbed.render(resolution[0], resolution[1], spp, True, float(i)/numframes, float(i + 1)/numframes, fps, shutter_fraction=0.5)
+            frame_filename = frames_dir / f"{i:04d}.png"
+            image_writer.write(str(frame_filename), np.clip(frame * 2**exposure, 0.0, 1.0), quality=100)
 
     """
     The -c:v option sets the codec for the video stream. libx264 is the codec for H.264 encoding, which provides efficient compression and is widely compatible.    
@@ -48,10 +59,11 @@ def parse_args():
     parser.add_argument("--n_seconds", type=int, default=1, help="Number of steps to train for before quitting.")
     parser.add_argument("--fps", type=int, default=60, help="number of fps")
     parser.add_argument("--spp", type=int, default=64, help="Number of samples per pixel. A larger number means less noise, but slower rendering.")
+    parser.add_argument("--save_frames", action="store_true", help="Keep every frame as a PNG in a frames directory next to the snapshot and encode the video from those, instead of streaming the frames into ffmpeg.")
 
     args = parser.parse_args()
     return args
 
 if __name__ == "__main__":
     args = parse_args()
-    render_video([args.width, args.height], args.n_seconds*args.fps, args.snapshot, args.camera_path, spp=args.spp, fps=args.fps)
\ No newline at end of file
+    render_video([args.width, args.height], args.n_seconds*args.fps, args.snapshot, args.camera_path, spp=args.spp, fps=args.fps, save_frames=args.save_frames)
\ No newline at end of file
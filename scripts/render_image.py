@@ -9,24 +9,19 @@ import pyngp as ngp # noqa
 import numpy as np
 import logging
 import json
-from common import write_image, linear_to_srgb, compute_error, mse2psnr
 
 logging.basicConfig(level=logging.DEBUG)
 
-def render_images(snapshot, test_transforms, output_dir):
+def render_images(snapshot, test_transforms, output_dir, test_masks="", reference_from_disk=False, reference_cache_dir="", adaptive_spp=False):
     testbed = ngp.Testbed(ngp.TestbedMode.Nerf)
     testbed.load_snapshot(snapshot)
 
     print("Evaluating test transforms from ", args.test_transforms)
-    totmse = 0
-    totpsnr = 0
-    totssim = 0
-    totcount = 0
-    minpsnr = 1000
-    maxpsnr = 0
+    metric_engine = common.MetricEngine(["MSE", "PSNR", "SSIM"], histograms=True)
 
     # Evaluate metrics on black background
-    testbed.background_color = [1.0, 1.0, 1.0, 1.0]
+    background_color = [1.0, 1.0, 1.0, 1.0]
+    testbed.background_color = background_color
 
     testbed.snap_to_pixel_centers = False
     spp = 8
@@ -35,43 +30,58 @@ def render_images(snapshot, test_transforms, output_dir):
 
     testbed.shall_train = False
     testbed.load_training_data(test_transforms)
+    with open(test_transforms) as f:
+        transforms = json.load(f)
+    frames = transforms["frames"]
 
-    with tqdm(range(testbed.nerf.training.dataset.n_images), unit="images", desc=f"Rendering test frame") as t:
+    if reference_from_disk:
+        # The dataset's images are in the order of the transforms' frames.
+        references = common.prefetch_images(common.frame_image_paths(transforms, test_transforms), disk_cache_dir=reference_cache_dir or None)
+
+    with tqdm(range(testbed.nerf.training.dataset.n_images), unit="images", desc=f"Rendering test frame") as t, common.AsyncImageWriter() as image_writer, common.EvaluationPipeline(metric_engine) as evaluator:
         for i in t:
             resolution = testbed.nerf.training.dataset.metadata[i].resolution
-            testbed.render_ground_truth = True
             testbed.set_camera_to_training_view(i)
-            ref_image = testbed.render(resolution[0], resolution[1], 1, True)
-            testbed.render_ground_truth = False
-            image = testbed.render(resolution[0], resolution[1], spp, True)
+            if reference_from_disk:
+                ref_image = common.composite_background(references[i].result(), background_color, testbed.exposure, testbed.color_space == ngp.ColorSpace.SRGB)
+                if ref_image.shape[:2] != (resolution[1], resolution[0]):
+                    raise ValueError(f"Reference image {i} has {ref_image.shape[1]}x{ref_image.shape[0]} pixels, but is rendered at {resolution[0]}x{resolution[1]}.")
+                if i == 0:
+                    testbed.render_ground_truth = True
+                    common.check_disk_reference(ref_image, testbed.render(resolution[0], resolution[1], 1, True))
+                    testbed.render_ground_truth = False
+            else:
+                testbed.render_ground_truth = True
+                ref_image = testbed.render(resolution[0], resolution[1], 1, True)
+                testbed.render_ground_truth = False
+            if adaptive_spp:
+                mask = common.read_mask(common.find_mask_file(test_masks, frames[i]["file_path"])) if test_masks else None
+                image, image_spp, trace = common.render_adaptive(lambda n: testbed.render(resolution[0], resolution[1], n, True), ref_image, spp, mask=mask)
+                print(f"Image {i}: {image_spp} spp, trace {trace}")
+            else:
+                image = testbed.render(resolution[0], resolution[1], spp, True)
 
             ref_image_path = os.path.join(output_dir, f"ref_{i:04d}.png")
             out_image_path = os.path.join(output_dir, f"out_{i:04d}.png")
             diff_image_path = os.path.join(output_dir, f"diff_{i:04d}.png")
-            write_image(ref_image_path, ref_image)
-            write_image(out_image_path, image)
+            image_writer.write(ref_image_path, ref_image)
+            image_writer.write(out_image_path, image)
 
             diffimg = np.absolute(image - ref_image)
             diffimg[...,3:4] = 1.0
-            write_image(diff_image_path, diffimg)
-
-            A = np.clip(linear_to_srgb(image[...,:3]), 0.0, 1.0)
-            R = np.clip(linear_to_srgb(ref_image[...,:3]), 0.0, 1.0)
-            mse = float(compute_error("MSE", A, R))
-            ssim = float(compute_error("SSIM", A, R))
-            totssim += ssim
-            totmse += mse
-            psnr = mse2psnr(mse)
-            totpsnr += psnr
-            minpsnr = psnr if psnr<minpsnr else minpsnr
-            maxpsnr = psnr if psnr>maxpsnr else maxpsnr
-            totcount = totcount+1
-            t.set_postfix(psnr = totpsnr/(totcount or 1))
-
-    psnr_avgmse = mse2psnr(totmse/(totcount or 1))
-    psnr = totpsnr/(totcount or 1)
-    ssim = totssim/(totcount or 1)
-    log_entry = f"PSNR={psnr} [min={minpsnr} max={maxpsnr}] SSIM={ssim}"
+            image_writer.write(diff_image_path, diffimg)
+
+            mask = common.find_mask_file(test_masks, frames[i]["file_path"]) if test_masks else None
+            evaluator.submit(i, image, ref_image, mask)
+            completed = evaluator.completed()
+            if completed:
+                t.set_postfix(psnr = np.mean([r["PSNR"] for r in completed]))
+
+        results = evaluator.results()
+
+    mean, minimum, maximum = metric_engine.summarize(results)
+    psnr_avgmse = common.mse2psnr(mean["MSE"])
+    log_entry = f"PSNR={mean['PSNR']} [min={minimum['PSNR']} max={maximum['PSNR']}] SSIM={mean['SSIM']}"
 
     # Print to terminal
     print(log_entry)
@@ -81,16 +91,25 @@ def render_images(snapshot, test_transforms, output_dir):
     with open(log_file_path, "w") as log_file:
         log_file.write(log_entry + "\n")
 
+    # Per-pixel error distribution over the whole test set
+    error_statistics_path = os.path.join(args.output_dir, "error_statistics.json")
+    with open(error_statistics_path, "w") as f:
+        json.dump(metric_engine.error_statistics(), f, indent=2)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="render neural graphics primitives testbed, see documentation for how to")
     parser.add_argument("--snapshot", default="", help="The model snapshot to load")
     parser.add_argument("--test_transforms", default="", help="The test transforms to load")
     parser.add_argument("--output_dir", default="", help="The output directory")
+    parser.add_argument("--reference_from_disk", action="store_true", help="Read the reference images from the test transforms' file_path instead of rendering them")
+    parser.add_argument("--reference_cache_dir", default="", help="Directory in which decoded reference images are cached across runs")
+    parser.add_argument("--adaptive_spp", action="store_true", help="Render each view at 1, 2, 4, ... spp until its PSNR and SSIM converge, up to 8 spp")
+    parser.add_argument("--test_masks", default="", help="Directory of masks, named <image file name>.png, that restrict the metrics to each test image's foreground")
 
     args = parser.parse_args()
     return args
 
 if __name__ == "__main__":
     args = parse_args()
-    render_images(args.snapshot, args.test_transforms, args.output_dir)
\ No newline at end of file
+    render_images(args.snapshot, args.test_transforms, args.output_dir, args.test_masks, args.reference_from_disk, args.reference_cache_dir, args.adaptive_spp)
\ No newline at end of file
@@ -10,16 +10,18 @@
 
 import argparse
 import os
-import commentjson as json
 
 import numpy as np
 
-import shutil
+import signal
 import time
 
 from common import *
 from scenes import *
 
+# After the star imports, which would otherwise replace it with the standard json module
+import commentjson as json
+
 from tqdm import tqdm
 pyngp_path = '/home/leh19/workspace/instant-ngp/cmake-build-debug'
 sys.path.append(pyngp_path)
@@ -39,6 +41,15 @@ def parse_args():
 
 	parser.add_argument("--nerf_compatibility", action="store_true", help="Matches parameters with original NeRF. Can cause slowness and worse results on some scenes, but helps with high PSNR on synthetic scenes.")
 	parser.add_argument("--test_transforms", default="", help="Path to a nerf style transforms json from which we will compute PSNR.")
+	parser.add_argument("--reference_from_disk", action="store_true", help="Read the reference images of --test_transforms from their file_path instead of rendering them.")
+	parser.add_argument("--reference_cache_dir", default="", help="Directory in which decoded reference images are cached across runs that share a test split. Used with --reference_from_disk.")
+	parser.add_argument("--eval_cache_dir", default="", help="Directory of cached test metrics, keyed by the snapshot, the test transforms, their reference images and the render settings. Requires --save_snapshot, or --load_snapshot without training.")
+	parser.add_argument("--eval_metrics", nargs="+", default=["MSE", "PSNR", "SSIM"], help="Metrics to evaluate the test transforms with, e.g. MSE PSNR SSIM MS-SSIM FLIP. See common.compute_error().")
+	parser.add_argument("--eval_cache_images", action="store_true", help="Also cache the rendered test images, so that metrics added later are computed without rendering.")
+	parser.add_argument("--adaptive_spp", action="store_true", help="Render each test view at 1, 2, 4, ... samples per pixel until its PSNR and SSIM converge, instead of always using the maximum of 8.")
+	parser.add_argument("--spp_psnr_tolerance", type=float, default=0.05, help="PSNR change in dB between consecutive renders below which --adaptive_spp stops.")
+	parser.add_argument("--spp_ssim_tolerance", type=float, default=0.0005, help="SSIM change between consecutive renders below which --adaptive_spp stops.")
+	parser.add_argument("--test_masks", default="", help="Directory of masks, named <image file name>.png, that restrict the test metrics to each test image's foreground. See experiment_scripts/create_masks_from_annotations.py.")
 	parser.add_argument("--near_distance", default=-1, type=float, help="Set the distance from the camera at which training rays start for nerf. <0 means use ngp default")
 	parser.add_argument("--exposure", default=0.0, type=float, help="Controls the brightness of the image. Positive numbers increase brightness, negative numbers decrease it.")
 
@@ -71,6 +82,20 @@ def parse_args():
 
 	parser.add_argument("--sharpen", default=0, help="Set amount of sharpening applied to NeRF training images. Range 0.0 to 1.0.")
 
+	parser.add_argument("--telemetry_stride", type=int, default=10, help="Record training step, loss and timing every this many frames. Written next to the snapshot, or to the output directory.")
+	parser.add_argument("--telemetry_capacity", type=int, default=100000, help="Number of telemetry samples kept; older ones are overwritten.")
+	parser.add_argument("--target_loss", type=float, default=None, help="Report the time and step at which the training loss first reaches this value.")
+	parser.add_argument("--time_budget", type=float, default=0, help="Stop training after this many seconds, even if --n_steps has not been reached. 0 means no limit.")
+	parser.add_argument("--early_stop", action="store_true", help="Stop training once the smoothed training loss has plateaued; see the --early_stop_* options.")
+	parser.add_argument("--early_stop_window", type=int, default=100, help="Number of telemetry samples over which the loss slope is fitted.")
+	parser.add_argument("--early_stop_threshold", type=float, default=0.005, help="Relative loss decrease per 1000 steps below which the loss counts as plateaued.")
+	parser.add_argument("--early_stop_patience", type=int, default=2000, help="Number of steps the loss has to stay plateaued before training stops.")
+	parser.add_argument("--checkpoint_every", type=int, default=0, help="Write a checkpoint, including the optimizer state, every this many training steps. 0 disables checkpoints.")
+	parser.add_argument("--keep_checkpoints", type=int, default=3, help="Number of most recent checkpoints to keep. 0 keeps all of them.")
+	parser.add_argument("--resume", action="store_true", help="Continue training from the newest checkpoint in the checkpoint directory, if any, up to --n_steps. On SIGTERM or SIGUSR1, a last checkpoint is written before exiting, so that the next run with --resume picks up from there.")
+	parser.add_argument("--checkpoint_dir", default="", help="Directory of the checkpoints. Defaults to a checkpoints/ directory in --output_dir, or next to --save_snapshot.")
+	parser.add_argument("--chrome_trace", action="store_true", help="Also write the training telemetry as a Chrome trace (chrome://tracing, Perfetto).")
+
 
 	return parser.parse_args()
 
@@ -126,6 +151,14 @@ if __name__ == "__main__":
 	elif args.network:
 		testbed.reload_network_from_file(args.network)
 
+	checkpoint_dir = args.checkpoint_dir or os.path.join(args.output_dir or os.path.dirname(args.save_snapshot) or ".", "checkpoints")
+	if args.resume:
+		checkpoint = load_latest_checkpoint(testbed, checkpoint_dir)
+		if checkpoint:
+			print(f"Resuming from {checkpoint} at step {testbed.training_step}")
+		else:
+			print(f"No checkpoint to resume from in {checkpoint_dir}")
+
 	ref_transforms = {}
 	if args.screenshot_transforms: # try to load the given file straight away
 		print("Screenshot transforms from ", args.screenshot_transforms)
@@ -181,17 +214,53 @@ if __name__ == "__main__":
 		n_steps = 35000
 
 	tqdm_last_update = 0
+	telemetry = TrainingTelemetry(args.telemetry_capacity, args.telemetry_stride, args.target_loss)
+	loss_plateau = LossPlateau(args.early_stop_window, args.early_stop_threshold, args.early_stop_patience) if args.early_stop else None
+	checkpoints = None
+	received_signals = []
+	previous_signal_handlers = {}
+	if n_steps > 0 and (args.checkpoint_every > 0 or args.resume):
+		checkpoints = CheckpointWriter(checkpoint_dir, args.keep_checkpoints)
+		last_checkpoint_step = testbed.training_step
+		if args.resume:
+			# Schedulers send these ahead of killing the job. The handler only takes note;
+			# the training loop stops at the next frame and the checkpoint is written after it.
+			# The previous handlers are restored once training ends.
+			for signum in (signal.SIGTERM, getattr(signal, "SIGUSR1", None)):
+				if signum is not None:
+					previous_signal_handlers[signum] = signal.signal(signum, lambda received, frame: received_signals.append(received))
 	if n_steps > 0:
-		with tqdm(total=n_steps, desc="Training", unit="steps", disable=True) as t:
+		with tqdm(total=n_steps, desc="Training", unit="steps", disable=True) as t, telemetry.phase("training"):
 			while testbed.frame():
+				sampled = telemetry.record(testbed.training_step, testbed.loss)
 				if testbed.want_repl():
 					repl(testbed)
 
-				if testbed.training_step >= n_steps:
-					if args.gui:
-						testbed.shall_train = False
-					else:
-						break
+				if received_signals:
+					telemetry.stop_reason = signal.Signals(received_signals[0]).name
+					break
+
+				if args.checkpoint_every > 0 and checkpoints is not None and testbed.training_step - last_checkpoint_step >= args.checkpoint_every:
+					with telemetry.phase("checkpoint"):
+						checkpoints.save(testbed)
+					last_checkpoint_step = testbed.training_step
+
+				# Checked until training stops once; in the GUI, training may be resumed by hand afterwards.
+				if telemetry.stop_reason is None:
+					if testbed.training_step >= n_steps:
+						telemetry.stop_reason = "n_steps"
+					elif args.time_budget > 0 and telemetry.elapsed >= args.time_budget:
+						telemetry.stop_reason = "time_budget"
+					elif loss_plateau is not None and sampled and loss_plateau.update(telemetry):
+						telemetry.stop_reason = "early_stop"
+
+					if telemetry.stop_reason is not None:
+						if telemetry.stop_reason != "n_steps":
+							tqdm.write(f"Stopping training at step {testbed.training_step} ({telemetry.stop_reason})")
+						if args.gui:
+							testbed.shall_train = False
+						else:
+							break
 
 				# Reset progress if training step is reset
 				if testbed.training_step < old_training_step or old_training_step == 0:
@@ -206,24 +275,53 @@ if __name__ == "__main__":
 					old_training_step = testbed.training_step
 					tqdm_last_update = time.monotonic()
 
-	if args.save_snapshot:
+	# Past the training loop, nothing would act on received_signals anymore.
+	for signum, previous in previous_signal_handlers.items():
+		signal.signal(signum, previous)
+	if received_signals:
+		print(f"Received {signal.Signals(received_signals[0]).name}, writing a checkpoint at step {testbed.training_step}")
+		with telemetry.phase("checkpoint"):
+			checkpoints.save(testbed, compress=False)
+
+	if checkpoints is not None:
+		checkpoints.close()
+		telemetry.checkpoints = checkpoints.records
+		if checkpoints.records:
+			stall_time = sum(r["stall_time"] for r in checkpoints.records)
+			write_time = sum(r["write_time"] for r in checkpoints.records)
+			print(f"Wrote {len(checkpoints.records)} checkpoints to {checkpoints.directory}: training stalled for {stall_time:.1f}s, compression and writes took {write_time:.1f}s in the background")
+
+	if args.save_snapshot and not received_signals:
 		os.makedirs(os.path.dirname(args.save_snapshot), exist_ok=True)
-		testbed.save_snapshot(args.save_snapshot, False)
+		with telemetry.phase("save_snapshot"):
+			testbed.save_snapshot(args.save_snapshot, False)
+
+	if telemetry.n_frames > 0:
+		training_summary = telemetry.summary()
+		print(f"Trained {training_summary['steps']} steps in {training_summary['wall_time']:.1f}s, {training_summary['steps_per_second']:.1f} steps/sec, stopped by {training_summary['stop_reason']}")
+		if args.target_loss is not None:
+			if telemetry.time_to_target_loss is None:
+				print(f"Loss did not reach {args.target_loss}")
+			else:
+				print(f"Loss reached {args.target_loss} after {telemetry.time_to_target_loss:.1f}s, at step {telemetry.step_at_target_loss}")
+		telemetry_stem = os.path.splitext(args.save_snapshot)[0] if args.save_snapshot else os.path.join(args.output_dir, "training") if args.output_dir else ""
+		if telemetry_stem:
+			telemetry.write(telemetry_stem, args.chrome_trace)
+
+	if received_signals:
+		# Training is incomplete; leave the snapshot, evaluation and video to the resumed run.
+		sys.exit(128 + received_signals[0])
 
 	if args.test_transforms:
 		print("Evaluating test transforms from ", args.test_transforms)
 		with open(args.test_transforms) as f:
 			test_transforms = json.load(f)
 		data_dir=os.path.dirname(args.test_transforms)
-		totmse = 0
-		totpsnr = 0
-		totssim = 0
-		totcount = 0
-		minpsnr = 1000
-		maxpsnr = 0
+		eval_metrics = args.eval_metrics
 
 		# Evaluate metrics on black background
-		testbed.background_color = [1.0, 1.0, 1.0, 1.0]
+		background_color = [1.0, 1.0, 1.0, 1.0]
+		testbed.background_color = background_color
 
 		# Prior nerf papers don't typically do multi-sample anti aliasing.
 		# So snap all pixels to the pixel centers.
@@ -233,45 +331,105 @@ if __name__ == "__main__":
 		testbed.nerf.render_min_transmittance = 1e-4
 
 		testbed.shall_train = False
-		testbed.load_training_data(args.test_transforms)
-
-		with tqdm(range(testbed.nerf.training.dataset.n_images), unit="images", desc=f"Rendering test frame") as t:
-			for i in t:
-				resolution = testbed.nerf.training.dataset.metadata[i].resolution
-				testbed.render_ground_truth = True
-				testbed.set_camera_to_training_view(i)
-				ref_image = testbed.render(resolution[0], resolution[1], 1, True)
-				testbed.render_ground_truth = False
-				image = testbed.render(resolution[0], resolution[1], spp, True)
-
-				if i == 0:
-					ref_image_path = os.path.join(args.output_dir, "ref.png")
-					out_image_path = os.path.join(args.output_dir, "out.png")
-					diff_image_path = os.path.join(args.output_dir, "diff.png")
-					write_image(ref_image_path, ref_image)
-					write_image(out_image_path, image)
-
-					diffimg = np.absolute(image - ref_image)
-					diffimg[...,3:4] = 1.0
-					write_image(diff_image_path, diffimg)
-
-				A = np.clip(linear_to_srgb(image[...,:3]), 0.0, 1.0)
-				R = np.clip(linear_to_srgb(ref_image[...,:3]), 0.0, 1.0)
-				mse = float(compute_error("MSE", A, R))
-				ssim = float(compute_error("SSIM", A, R))
-				totssim += ssim
-				totmse += mse
-				psnr = mse2psnr(mse)
-				totpsnr += psnr
-				minpsnr = psnr if psnr<minpsnr else minpsnr
-				maxpsnr = psnr if psnr>maxpsnr else maxpsnr	
-				totcount = totcount+1
-				t.set_postfix(psnr = totpsnr/(totcount or 1))
-
-		psnr_avgmse = mse2psnr(totmse/(totcount or 1))
-		psnr = totpsnr/(totcount or 1)
-		ssim = totssim/(totcount or 1)
-		log_entry = f"PSNR={psnr} [min={minpsnr} max={maxpsnr}] SSIM={ssim}"
+		# The test set is only loaded once it is clear that something is not cached.
+		n_test_images = len(test_transforms["frames"])
+		reference_files = frame_image_paths(test_transforms, args.test_transforms)
+		mask_files = [find_mask_file(args.test_masks, frame["file_path"]) for frame in test_transforms["frames"]] if args.test_masks else []
+
+		eval_cache = None
+		cache_entry = {"metrics": {}, "error_statistics": {}}
+		snapshot = args.save_snapshot or (args.load_snapshot if n_steps <= 0 else "")
+		if args.eval_cache_dir and not snapshot:
+			print("Not caching the evaluation, which requires --save_snapshot, or --load_snapshot without training.")
+		elif args.eval_cache_dir:
+			eval_cache = EvaluationCache(args.eval_cache_dir, args.eval_cache_images)
+			render_settings = {
+				"spp": spp,
+				"adaptive_spp": [args.spp_psnr_tolerance, args.spp_ssim_tolerance] if args.adaptive_spp else None,
+				"background_color": background_color,
+				"snap_to_pixel_centers": False,
+				"render_min_transmittance": 1e-4,
+				"exposure": args.exposure,
+				"nerf_compatibility": args.nerf_compatibility,
+				"reference_from_disk": args.reference_from_disk,
+			}
+			eval_cache_key = eval_cache.key([snapshot, args.test_transforms] + reference_files + mask_files, render_settings)
+			cache_entry = eval_cache.load(eval_cache_key) or cache_entry
+
+		# Only the metrics that are not cached yet are computed.
+		metric_engine = MetricEngine([m for m in eval_metrics if m not in cache_entry["metrics"]], histograms=True)
+		if not metric_engine.metrics:
+			print("Using cached test metrics")
+			results = EvaluationCache.results(cache_entry, eval_metrics)
+		else:
+			testbed.load_training_data(args.test_transforms)
+			cached_images = eval_cache is not None and eval_cache.has_images(eval_cache_key, n_test_images)
+			if args.reference_from_disk and not cached_images:
+				# The dataset's images are in the order of the transforms' frames.
+				references = prefetch_images(reference_files, disk_cache_dir=args.reference_cache_dir or None)
+
+			spp_traces = []
+
+			# Metrics are computed on background threads while the next frames render.
+			with tqdm(range(n_test_images), unit="images", desc=f"Rendering test frame") as t, AsyncImageWriter() as image_writer, EvaluationPipeline(metric_engine) as evaluator:
+				for i in t:
+					resolution = testbed.nerf.training.dataset.metadata[i].resolution
+					testbed.set_camera_to_training_view(i)
+					if cached_images:
+						image, ref_image = eval_cache.load_images(eval_cache_key, i)
+					elif args.reference_from_disk:
+						ref_image = composite_background(references[i].result(), background_color, testbed.exposure, testbed.color_space == ngp.ColorSpace.SRGB)
+						if ref_image.shape[:2] != (resolution[1], resolution[0]):
+							raise ValueError(f"Reference image {i} has {ref_image.shape[1]}x{ref_image.shape[0]} pixels, but is rendered at {resolution[0]}x{resolution[1]}.")
+						if i == 0:
+							testbed.render_ground_truth = True
+							check_disk_reference(ref_image, testbed.render(resolution[0], resolution[1], 1, True))
+							testbed.render_ground_truth = False
+					else:
+						testbed.render_ground_truth = True
+						ref_image = testbed.render(resolution[0], resolution[1], 1, True)
+						testbed.render_ground_truth = False
+					if not cached_images and args.adaptive_spp:
+						mask = read_mask(mask_files[i]) if mask_files else None
+						image, image_spp, trace = render_adaptive(lambda n: testbed.render(resolution[0], resolution[1], n, True), ref_image, spp, args.spp_psnr_tolerance, args.spp_ssim_tolerance, mask)
+						spp_traces.append({"image": i, "spp": image_spp, "trace": trace})
+					elif not cached_images:
+						image = testbed.render(resolution[0], resolution[1], spp, True)
+					if not cached_images:
+						if eval_cache is not None:
+							eval_cache.save_images(eval_cache_key, i, image, ref_image)
+
+					if i == 0:
+						ref_image_path = os.path.join(args.output_dir, "ref.png")
+						out_image_path = os.path.join(args.output_dir, "out.png")
+						diff_image_path = os.path.join(args.output_dir, "diff.png")
+						image_writer.write(ref_image_path, ref_image)
+						image_writer.write(out_image_path, image)
+
+						diffimg = np.absolute(image - ref_image)
+						diffimg[...,3:4] = 1.0
+						image_writer.write(diff_image_path, diffimg)
+
+					evaluator.submit(i, image, ref_image, mask_files[i] if mask_files else None)
+					completed = evaluator.completed()
+					if completed and "PSNR" in metric_engine.metrics:
+						t.set_postfix(psnr = np.mean([r["PSNR"] for r in completed]))
+
+				results = evaluator.results()
+
+			if spp_traces:
+				print(f"Adaptive spp: mean {np.mean([t['spp'] for t in spp_traces]):.2f}, max {max(t['spp'] for t in spp_traces)}")
+				with open(os.path.join(args.output_dir, "adaptive_spp.json"), "w") as f:
+					json.dump(spp_traces, f, indent=2)
+
+			if eval_cache is not None:
+				cache_entry = eval_cache.update(eval_cache_key, results, metric_engine.error_statistics())
+				results = EvaluationCache.results(cache_entry, eval_metrics)
+			else:
+				cache_entry["error_statistics"] = metric_engine.error_statistics()
+
+		mean, minimum, maximum = MetricEngine(eval_metrics).summarize(results)
+		log_entry = " ".join(f"{m}={mean[m]} [min={minimum[m]} max={maximum[m]}]" if m == "PSNR" else f"{m}={mean[m]}" for m in eval_metrics)
 
 		# Print to terminal
 		print(log_entry)
@@ -281,6 +439,11 @@ if __name__ == "__main__":
 		with open(log_file_path, "w") as log_file:
 			log_file.write(log_entry + "\n")
 
+		# Per-pixel error distribution over the whole test set
+		error_statistics_path = os.path.join(args.output_dir, "error_statistics.json")
+		with open(error_statistics_path, "w") as f:
+			json.dump(cache_entry["error_statistics"], f, indent=2)
+
 
 	if args.save_mesh:
 		res = args.marching_cubes_res or 256
@@ -294,20 +457,21 @@ if __name__ == "__main__":
 		if not args.screenshot_frames:
 			args.screenshot_frames = range(len(ref_transforms["frames"]))
 		print(args.screenshot_frames)
-		for idx in args.screenshot_frames:
-			f = ref_transforms["frames"][int(idx)]
-			cam_matrix = f.get("transform_matrix", f["transform_matrix_start"])
-			testbed.set_nerf_camera_matrix(np.matrix(cam_matrix)[:-1,:])
-			outname = os.path.join(args.screenshot_dir, os.path.basename(f["file_path"]))
-
-			# Some NeRF datasets lack the .png suffix in the dataset metadata
-			if not os.path.splitext(outname)[1]:
-				outname = outname + ".png"
-
-			print(f"rendering {outname}")
-			image = testbed.render(args.width or int(ref_transforms["w"]), args.height or int(ref_transforms["h"]), args.screenshot_spp, True)
-			os.makedirs(os.path.dirname(outname), exist_ok=True)
-			write_image(outname, image)
+		with AsyncImageWriter() as image_writer:
+			for idx in args.screenshot_frames:
+				f = ref_transforms["frames"][int(idx)]
+				cam_matrix = f.get("transform_matrix", f["transform_matrix_start"])
+				testbed.set_nerf_camera_matrix(np.matrix(cam_matrix)[:-1,:])
+				outname = os.path.join(args.screenshot_dir, os.path.basename(f["file_path"]))
+
+				# Some NeRF datasets lack the .png suffix in the dataset metadata
+				if not os.path.splitext(outname)[1]:
+					outname = outname + ".png"
+
+				print(f"rendering {outname}")
+				image = testbed.render(args.width or int(ref_transforms["w"]), args.height or int(ref_transforms["h"]), args.screenshot_spp, True)
+				os.makedirs(os.path.dirname(outname), exist_ok=True)
+				image_writer.write(outname, image)
 	elif args.screenshot_dir:
 		outname = os.path.join(args.screenshot_dir, args.scene + "_" + network_stem)
 		print(f"Rendering {outname}.png")
@@ -324,30 +488,27 @@ if __name__ == "__main__":
 		save_frames = "%" in args.video_output
 		start_frame, end_frame = args.video_render_range
 
-		if "tmp" in os.listdir():
-			shutil.rmtree("tmp")
-		os.makedirs("tmp")
-
-		for i in tqdm(list(range(min(n_frames, n_frames+1))), unit="frames", desc=f"Rendering video"):
-			testbed.camera_smoothing = args.video_camera_smoothing
-
-			if start_frame >= 0 and i < start_frame:
-				# For camera smoothing and motion blur to work, we cannot just start rendering
-				# from middle of the sequence. Instead we render a very small image and discard it
-				# for these initial frames.
-				# TODO Replace this with a no-op render method once it's available
-				frame = testbed.render(32, 32, 1, True, float(i)/n_frames, float(i + 1)/n_frames, args.video_fps, shutter_fraction=0.5)
-				continue
-			elif end_frame >= 0 and i > end_frame:
-				continue
-
-			frame = testbed.render(resolution[0], resolution[1], args.video_spp, True, float(i)/n_frames, float(i + 1)/n_frames, args.video_fps, shutter_fraction=0.5)
-			if save_frames:
-				write_image(args.video_output % i, np.clip(frame * 2**args.exposure, 0.0, 1.0), quality=100)
-			else:
-				write_image(f"tmp/{i:04d}.jpg", np.clip(frame * 2**args.exposure, 0.0, 1.0), quality=100)
-
-		if not save_frames:
-			os.system(f"ffmpeg -y -framerate {args.video_fps} -i tmp/%04d.jpg -c:v libx264 -pix_fmt yuv420p {args.video_output}")
-
-		shutil.rmtree("tmp")
+		# Leaving the with block waits for the last frames and, when streaming, for ffmpeg to finish the file.
+		if save_frames:
+			video_writer = AsyncImageWriter()
+		else:
+			video_writer = VideoWriter(args.video_output, resolution[0], resolution[1], args.video_fps)
+		with video_writer:
+			for i in tqdm(list(range(min(n_frames, n_frames+1))), unit="frames", desc=f"Rendering video"):
+				testbed.camera_smoothing = args.video_camera_smoothing
+
+				if start_frame >= 0 and i < start_frame:
+					# For camera smoothing and motion blur to work, we cannot just start rendering
+					# from middle of the sequence. Instead we render a very small image and discard it
+					# for these initial frames.
+					# TODO Replace this with a no-op render method once it's available
+					frame = testbed.render(32, 32, 1, True, float(i)/n_frames, float(i + 1)/n_frames, args.video_fps, shutter_fraction=0.5)
+					continue
+				elif end_frame >= 0 and i > end_frame:
+					continue
+
+				frame = testbed.render(resolution[0], resolution[1], args.video_spp, True, float(i)/n_frames, float(i + 1)/n_frames, args.video_fps, shutter_fraction=0.5)
+				if save_frames:
+					video_writer.write(args.video_output % i, np.clip(frame * 2**args.exposure, 0.0, 1.0), quality=100)
+				else:
+					video_writer.write(np.clip(frame * 2**args.exposure, 0.0, 1.0))